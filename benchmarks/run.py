@@ -0,0 +1,142 @@
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import click
+import numpy as np
+
+from src.profiling import reset_peak_rss, get_peak_rss
+from src.utils import split_cn_profiles
+from benchmarks.synthetic import simulate_rho, simulate_cn_profiles, simulate_data, simulate_readcounts, simulate_counts, simulate_allele_counts, write_fixtures
+
+STAGES = ['remove_outliers', 'intersect', 'get_counts', 'process_counts', 'inference', 'save_results']
+
+
+def measure(results, stage, function, items, unit, **info):
+    """
+    Time function() and append a record with its throughput and peak RSS to results
+    Arguments:
+        results: list of dictionaries
+        stage: a string
+        function: a function without arguments
+        items: an integer - amount of work done by function (ex. number of bins)
+        unit: a string - what items counts
+        info: extra fields of the record
+    Returns:
+        The return value of function
+    """
+    reset_peak_rss()
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    results.append({'stage': stage, 'seconds': seconds, 'items': items, 'unit': unit, 'throughput': items / seconds, 'peak_rss_mb': get_peak_rss(), **info})
+    print(f"{stage:<16} {seconds:8.3f} s  {items / seconds:12.0f} {unit}/s  {' '.join(f'{k}={v}' for k, v in info.items())}", file=sys.stderr)
+    return value
+
+def min_ess(samples):
+    from numpyro.diagnostics import effective_sample_size
+    return float(np.min(effective_sample_size(np.asarray(samples['rho'], dtype=float))))
+
+def benchmark_inference(results, model, data, cn_profiles, counts, engine, num_samples, num_warmup, compress, num_bins):
+    """
+    Fit the model twice with inputs of the same shape - the first fit includes compilation, the second is timed as
+    the per-sample cost (NUTS reuses its compiled kernel through pad_buckets)
+    """
+    from src.inference import run_inference
+    from src.variational import run_variational
+
+    def fit(seed):
+        if engine == 'nuts':
+            return run_inference(model, data, cn_profiles, counts, num_samples, num_warmup, seed, False, False, pad_buckets=True, compress=compress)
+        return run_variational(model, data, cn_profiles, counts, engine, num_samples, 20000, 0.05, seed, False, compress)
+
+    start = time.perf_counter()
+    fit(1)
+    first = time.perf_counter() - start
+    samples = measure(results, f'inference_{engine}', lambda: fit(2), num_samples, 'draws', bins=num_bins, model=model, compress=compress)
+    results[-1]['compile_seconds'] = max(first - results[-1]['seconds'], 0)
+    results[-1]['ess_per_second'] = min_ess(samples) / results[-1]['seconds']
+    return samples
+
+@click.command()
+@click.option('--bins', type=click.STRING, default='5000,50000', help='Comma separated numbers of bins')
+@click.option('--clones', type=click.INT, default=3, help='Number of tumour clones')
+@click.option('--snvs', type=click.INT, default=2000, help='Number of SNVs (0 fits the cn model instead of cn_snv)')
+@click.option('--reads', type=click.INT, default=20000, help='Reads per contig in each synthetic bam file')
+@click.option('--fixture-snvs', type=click.INT, default=2000, help='SNVs per contig in the synthetic vcf file')
+@click.option('--engines', type=click.STRING, default='nuts', help='Comma separated inference engines (nuts, svi, laplace)')
+@click.option('--num-samples', type=click.INT, default=1000, help='Number of posterior draws')
+@click.option('--num-warmup', type=click.INT, default=200, help='Number of NUTS warm up draws')
+@click.option('--compress', type=click.BOOL, default=True, help='Fit the compressed models')
+@click.option('--stages', type=click.STRING, default=','.join(STAGES), help='Comma separated stages to run')
+@click.option('--seed', type=click.INT, default=0, help='Seed of the synthetic data')
+@click.option('--output', type=click.STRING, default=None, help='Path of the JSON report (printed to stdout by default)')
+def main(bins, clones, snvs, reads, fixture_snvs, engines, num_samples, num_warmup, compress, stages, seed, output):
+    """ Time the LiquidBayes pipeline stages on synthetic data.
+    """
+    from src.preprocessing import remove_outliers, intersect
+    from src.output import save_results
+
+    stages = stages.split(',')
+    rng = np.random.default_rng(seed)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='liquid-bayes-benchmarks')
+
+    if 'get_counts' in stages:
+        from src.process_snvs import get_counts, parse_sites
+        liquid_bam, _, vcf_path = write_fixtures(os.path.join(work_dir, 'fixtures'), 1, reads, fixture_snvs, rng)
+        sites = measure(results, 'parse_sites', lambda: parse_sites(vcf_path), 2 * fixture_snvs, 'sites')
+        for count_mode in ['coverage', 'pileup']:
+            measure(results, 'get_counts', lambda: get_counts(liquid_bam, sites, False, count_mode=count_mode), 2 * fixture_snvs, 'sites', count_mode=count_mode, reads=2 * reads)
+
+    for num_bins in [int(b) for b in bins.split(',')]:
+        rho = simulate_rho(clones, rng)
+        raw_cn_profiles = simulate_cn_profiles(num_bins, clones, rng)
+        raw_data = simulate_data(raw_cn_profiles, rho, 0.1, rng)
+
+        if 'intersect' in stages:
+            cn_profiles_path = os.path.join(work_dir, f'cn_profiles{num_bins}.bed')
+            np.savetxt(cn_profiles_path, raw_cn_profiles, fmt='%d', delimiter='\t')
+            readcounts = simulate_readcounts(raw_cn_profiles, raw_data)
+            measure(results, 'intersect', lambda: intersect(readcounts, cn_profiles_path), num_bins, 'bins', bins=num_bins)
+
+        # the typed arrays returned by utils.load_data
+        raw_bins, raw_cns = split_cn_profiles(raw_cn_profiles)
+        data, cn_bins, cn_profiles = measure(results, 'remove_outliers', lambda: remove_outliers(raw_data.astype(np.float32), raw_bins, raw_cns, False), num_bins, 'bins', bins=num_bins) \
+            if 'remove_outliers' in stages else (raw_data.astype(np.float32), raw_bins, raw_cns)
+
+        if 'process_counts' in stages and snvs > 0:
+            from src.process_snvs import process_counts
+            counts_liquid, counts_clones = simulate_allele_counts(cn_bins, snvs, clones, rng)
+            measure(results, 'process_counts', lambda: process_counts(counts_liquid, counts_clones, cn_bins, cn_profiles, False), snvs, 'snvs', bins=num_bins)
+
+        if 'inference' not in stages and 'save_results' not in stages:
+            continue
+        model, counts = ('cn_snv', simulate_counts(snvs, clones, rho, rng)) if snvs > 0 else ('cn', None)
+        for engine in engines.split(','):
+            samples = benchmark_inference(results, model, data, cn_profiles, counts, engine, num_samples, num_warmup, compress, num_bins)
+
+        if 'save_results' in stages:
+            num_draws = int(np.prod(np.shape(samples['tau'])))
+            for extension in ['.csv', '.parquet']:
+                path = os.path.join(work_dir, f'draws{num_bins}{extension}')
+                measure(results, 'save_results', lambda: save_results(path, samples, clones, False), num_draws, 'draws', format=extension[1:])
+
+    import jax
+    report = {
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                    'numpy': np.__version__, 'jax': jax.__version__},
+        'parameters': {'bins': bins, 'clones': clones, 'snvs': snvs, 'reads': reads, 'fixture_snvs': fixture_snvs, 'engines': engines,
+                       'num_samples': num_samples, 'num_warmup': num_warmup, 'compress': compress, 'seed': seed},
+        'results': results,
+    }
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import os
+import numpy as np
+import pandas as pd
+
+NORMAL_CN = 2
+READ_LENGTH = 100
+
+
+def simulate_rho(num_clones, rng):
+    """
+    Draw clone prevalences from a flat Dirichlet
+    Arguments:
+        num_clones: an integer - number of tumour clones (normal is added as the last entry)
+        rng: a numpy Generator
+    Returns:
+        (num_clones+1,) ndarray
+    """
+    return rng.dirichlet(np.ones(num_clones + 1))
+
+def simulate_cn_profiles(num_bins, num_clones, rng, num_chrs=22, bin_size=500000, segment_length=50, max_cn=5):
+    """
+    Simulate piecewise constant copy-number profiles (segments of about segment_length bins) in the format of the
+    --cn-profiles-path bed file
+    Arguments:
+        num_bins: an integer
+        num_clones: an integer - number of tumour clones
+        rng: a numpy Generator
+        num_chrs: an integer
+        bin_size: an integer
+        segment_length: an integer - mean number of bins per segment
+        max_cn: an integer
+    Returns:
+        (num_bins, 3+num_clones+1) ndarray - chr, start, end (1-based, inclusive), one column per clone and the normal
+    """
+    num_chrs = min(num_chrs, num_bins)  # every chromosome gets at least one bin
+    chrs = np.sort(np.r_[np.arange(1, num_chrs + 1), rng.integers(1, num_chrs + 1, num_bins - num_chrs)])
+    first = np.r_[True, chrs[1:] != chrs[:-1]]
+    index_in_chr = np.arange(num_bins) - np.maximum.accumulate(np.where(first, np.arange(num_bins), 0))
+    starts = index_in_chr * bin_size + 1
+
+    # clones share a baseline profile and differ by private segments
+    breakpoints = first | (rng.random(num_bins) < 1 / segment_length)
+    segments = np.cumsum(breakpoints) - 1
+    baseline = rng.integers(1, max_cn + 1, segments[-1] + 1)[segments]
+    profiles = np.repeat(baseline[:, None], num_clones, axis=1)
+    for clone in range(num_clones):
+        private = (rng.random(segments[-1] + 1) < 0.2)[segments]
+        profiles[private, clone] = rng.integers(0, max_cn + 1, segments[-1] + 1)[segments][private]
+
+    return np.c_[chrs, starts, starts + bin_size - 1, profiles, np.full(num_bins, NORMAL_CN)].astype(float)
+
+def simulate_data(cn_profiles, rho, tau, rng, outlier_fraction=0.01):
+    """
+    Simulate corrected liquid log-ratios from models.base
+    Arguments:
+        cn_profiles: ndarray from simulate_cn_profiles
+        rho: (num_clones+1,) ndarray
+        tau: a float
+        rng: a numpy Generator
+        outlier_fraction: a float - fraction of bins replaced by uniform noise
+    Returns:
+        (num_bins,) ndarray
+    """
+    total = cn_profiles[:, 3:] @ rho
+    with np.errstate(divide='ignore'):
+        mu = np.log(total) - np.log(total.mean())
+    data = mu + tau * rng.standard_t(4, len(mu))
+    outliers = rng.random(len(mu)) < outlier_fraction
+    data[outliers] = rng.uniform(-3, 3, outliers.sum())
+    return data
+
+def simulate_readcounts(cn_profiles, data):
+    """
+    Corrected readcounts in the format returned by preprocessing.correct_reads, on the bins of cn_profiles
+    Returns:
+        Pandas dataframe with columns [chr, start, end, copy]
+    """
+    return pd.DataFrame({'chr': cn_profiles[:, 0].astype(int).astype(str),
+                         'start': cn_profiles[:, 1].astype(np.int64),
+                         'end': cn_profiles[:, 2].astype(np.int64),
+                         'copy': data})
+
+def simulate_counts(num_snvs, num_clones, rho, rng, depth=30):
+    """
+    Simulate the (L, 2+K) count matrix of models.extended (--counts-mat)
+    Arguments:
+        num_snvs: an integer
+        num_clones: an integer
+        rho: (num_clones+1,) ndarray
+        rng: a numpy Generator
+        depth: an integer - mean depth
+    Returns:
+        (num_snvs, 2+num_clones) ndarray - ref and alt counts of the liquid sample and the coefficient of each clone
+    """
+    coefficients = rng.integers(0, 3, (num_snvs, num_clones)) * rng.random((num_snvs, num_clones))
+    depths = rng.poisson(depth, num_snvs)
+    alt = rng.binomial(depths, 1 / (1 + np.exp(-coefficients @ rho[:-1])))
+    return np.c_[depths - alt, alt, coefficients].astype(float)
+
+def simulate_allele_counts(bins, num_snvs, num_clones, rng, depth=30):
+    """
+    Simulate allele counts at SNVs inside bins, in the format returned by process_snvs.get_counts
+    Arguments:
+        bins: (n, 3) ndarray - chr, start, end (the first columns of simulate_cn_profiles)
+        num_snvs: an integer
+        num_clones: an integer
+        rng: a numpy Generator
+        depth: an integer - mean depth
+    Returns:
+        Pandas dataframe for the liquid sample and a list of num_clones dataframes - columns [chr, pos, ref_counts, alt_counts]
+    """
+    rows = rng.integers(0, len(bins), num_snvs)
+    positions = bins[rows, 1].astype(np.int64) + rng.integers(0, bins[rows, 2].astype(np.int64) - bins[rows, 1] + 1)
+    chrs = bins[rows, 0].astype(np.int64)
+
+    def sample_counts(vaf):
+        depths = rng.poisson(depth, num_snvs)
+        alt = rng.binomial(depths, vaf)
+        return pd.DataFrame({'chr': chrs, 'pos': positions, 'ref_counts': depths - alt, 'alt_counts': alt})
+
+    return sample_counts(rng.uniform(0, 0.5, num_snvs)), [sample_counts(rng.uniform(0, 1, num_snvs)) for _ in range(num_clones)]
+
+def write_bam(path, contigs, num_reads, rng):
+    """
+    Write a sorted and indexed bam file with num_reads random reads per contig (with some duplicates, secondary
+    alignments and low mapping qualities so the read filters are exercised)
+    Arguments:
+        path: a string
+        contigs: list of (name, length) tuples
+        num_reads: an integer
+        rng: a numpy Generator
+    """
+    import pysam
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': name, 'LN': length} for name, length in contigs]}
+    unsorted_path = path + '.unsorted.bam'
+    qualities = pysam.qualitystring_to_array('I' * READ_LENGTH)
+    with pysam.AlignmentFile(unsorted_path, 'wb', header=header) as bam:
+        for contig_id, (name, length) in enumerate(contigs):
+            starts = rng.integers(0, length - READ_LENGTH, num_reads)
+            flags = rng.choice([0, 16, 1024, 256], num_reads, p=[0.47, 0.47, 0.03, 0.03])
+            mapping_qualities = rng.choice([60, 10], num_reads, p=[0.95, 0.05])
+            sequences = np.array(list('ACGT'))[rng.integers(0, 4, (num_reads, READ_LENGTH))].view(f'<U{READ_LENGTH}').ravel()
+            for i in range(num_reads):
+                read = pysam.AlignedSegment()
+                read.query_name = f'{name}_{i}'
+                read.query_sequence = str(sequences[i])
+                read.flag = int(flags[i])
+                read.reference_id = contig_id
+                read.reference_start = int(starts[i])
+                read.mapping_quality = int(mapping_qualities[i])
+                read.cigar = [(0, READ_LENGTH)]
+                read.query_qualities = qualities
+                bam.write(read)
+    pysam.sort('-o', path, unsorted_path)
+    os.remove(unsorted_path)
+    pysam.index(path)
+
+def write_vcf(path, contigs, num_snvs, rng):
+    """
+    Write a bgzipped and indexed vcf file with num_snvs bi-allelic SNVs per contig
+    Arguments:
+        path: a string (.vcf.gz)
+        contigs: list of (name, length) tuples
+        num_snvs: an integer
+        rng: a numpy Generator
+    """
+    import pysam
+    header = pysam.VariantHeader()
+    for name, length in contigs:
+        header.contigs.add(name, length=length)
+    plain_path = path[:-len('.gz')]
+    with pysam.VariantFile(plain_path, 'w', header=header) as vcf:
+        for name, length in contigs:
+            for position in np.sort(rng.choice(np.arange(READ_LENGTH, length - READ_LENGTH), num_snvs, replace=False)):
+                ref, alt = rng.choice(list('ACGT'), 2, replace=False)
+                vcf.write(vcf.new_record(contig=name, start=int(position), alleles=(str(ref), str(alt))))
+    pysam.tabix_index(plain_path, preset='vcf', force=True)
+
+def write_fixtures(directory, num_clones, num_reads, num_snvs, rng, contigs=(('1', 2000000), ('2', 2000000))):
+    """
+    Write bam files for a liquid sample and num_clones clones plus a tissue vcf
+    Arguments:
+        directory: a string
+        num_clones: an integer
+        num_reads: an integer - reads per contig and bam file
+        num_snvs: an integer - SNVs per contig
+        rng: a numpy Generator
+        contigs: list of (name, length) tuples
+    Returns:
+        Path to the liquid bam, list of paths to the clone bams and path to the vcf
+    """
+    os.makedirs(directory, exist_ok=True)
+    bam_paths = [os.path.join(directory, f'{name}.bam') for name in ['liquid'] + [f'clone{i}' for i in range(num_clones)]]
+    for bam_path in bam_paths:
+        write_bam(bam_path, list(contigs), num_reads, rng)
+    vcf_path = os.path.join(directory, 'tissue.vcf.gz')
+    write_vcf(vcf_path, list(contigs), num_snvs, rng)
+    return bam_paths[0], bam_paths[1:], vcf_path
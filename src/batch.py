@@ -0,0 +1,157 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from src.main import preprocess, get_count_cache_dir, clear_caches
+from src.output import save_results
+from src.profiling import profiled, stage
+from src.utils import CN_MODELS, _print
+
+
+def read_manifest(manifest):
+    """
+    Read a tab delimited manifest with one liquid sample per row
+    Arguments:
+        manifest: a string
+    Returns:
+        Pandas dataframe with (at least) the columns [liquid_bam, output]
+    """
+    samples = pd.read_csv(manifest, sep='\t', dtype=str)
+    missing = {'liquid_bam', 'output'} - set(samples.columns)
+    if len(missing) > 0:
+        raise RuntimeError(f"Manifest {manifest} is missing columns {', '.join(sorted(missing))}")
+    return samples
+
+def _preprocess_sample(args):
+    return preprocess(*args)
+
+def pad_samples(samples, pad_buckets=False):
+    """
+    Stack the preprocessed inputs of several samples, padding bins and SNVs to the largest sample
+    Arguments:
+        samples: list of (data, cn_profiles, counts) tuples
+        pad_buckets: a boolean - pad further to the size bucket of the largest sample (see inference.bucket_size)
+    Returns:
+        Five ndarrays (data, cn_profiles, mask, counts, snv_mask) - counts and snv_mask are None if the samples have no counts
+    """
+    from src.inference import bucket_size, FLOAT_DTYPE
+    num_bins = max(len(data) for data, _, _ in samples)
+    if pad_buckets:
+        num_bins = bucket_size(num_bins)
+    num_clones = samples[0][1].shape[1]
+    data = np.zeros((len(samples), num_bins), dtype=FLOAT_DTYPE)
+    cn_dtype = np.result_type(*[sample_cn_profiles.dtype for _, sample_cn_profiles, _ in samples])
+    cn_profiles = np.ones((len(samples), num_bins, num_clones), dtype=cn_dtype)  # log(sum(cn*rho)) must stay finite on padding
+    mask = np.zeros((len(samples), num_bins), dtype=bool)
+    for i, (sample_data, sample_cn_profiles, _) in enumerate(samples):
+        data[i, :len(sample_data)] = sample_data
+        cn_profiles[i, :len(sample_data)] = sample_cn_profiles
+        mask[i, :len(sample_data)] = True
+
+    if samples[0][2] is None:
+        return data, cn_profiles, mask, None, None
+
+    num_snvs = max(len(counts) for _, _, counts in samples)
+    if pad_buckets:
+        num_snvs = bucket_size(num_snvs)
+    counts = np.zeros((len(samples), num_snvs, samples[0][2].shape[1]), dtype=FLOAT_DTYPE)
+    snv_mask = np.zeros((len(samples), num_snvs), dtype=bool)
+    for i, (_, _, sample_counts) in enumerate(samples):
+        counts[i, :len(sample_counts)] = sample_counts
+        snv_mask[i, :len(sample_counts)] = True
+    return data, cn_profiles, mask, counts, snv_mask
+
+def run_batch(manifest,
+              batch_size,
+              cn_profiles_path,
+              clone_bams,
+              tissue_vcf,
+              counts_mat,
+              model,
+              num_samples,
+              num_warmup,
+              seed,
+              gc,
+              mapp,
+              progress_bar,
+              chrs,
+              bin_size,
+              qual,
+              verbose,
+              temp_dir,
+              num_workers,
+              count_mode,
+              use_cache,
+              clear_cache,
+              cache_size,
+              count_cache_dir,
+              correction,
+              read_counter,
+              num_chains,
+              chain_method,
+              pad_buckets,
+              jit_cache_dir,
+              engine,
+              svi_steps,
+              learning_rate,
+              compress,
+              thin,
+              profile,
+              profile_stages):
+    """
+    Fit many liquid samples against the same cn_profiles in one process. Samples are preprocessed on a process pool
+    and then fitted batch_size at a time with the stacked model - batches with the same padded shapes reuse one
+    compiled NUTS kernel. Each sample is written to the output listed in the manifest
+    """
+    with profiled(profile, profile_stages.split(',')):
+        if clear_cache:
+            clear_caches(temp_dir, count_cache_dir, verbose)
+
+        manifest = read_manifest(manifest)
+        _print(f'Preprocessing {len(manifest)} samples', verbose)
+
+        # clone bams are counted once up front, so samples only count their liquid bam and read the clone counts
+        # from the cache (instead of every worker counting them at the same time)
+        count_dir = get_count_cache_dir(count_cache_dir, temp_dir, use_cache)
+        if counts_mat is None and model not in CN_MODELS and clone_bams != ('',) and count_dir is not None:
+            from src.process_snvs import get_counts_parallel
+            with stage('get_counts', bams=len(clone_bams), count_mode=count_mode):
+                get_counts_parallel(list(clone_bams), tissue_vcf, num_workers, verbose, count_mode, count_dir, cache_size)
+
+        # samples are spread over the pool so each sample is preprocessed with a single worker
+        jobs = [(liquid_bam, cn_profiles_path, clone_bams, tissue_vcf, counts_mat, model, gc, mapp, chrs, bin_size, qual,
+                 False, temp_dir, 1, count_mode, use_cache, cache_size, correction, read_counter, count_cache_dir) for liquid_bam in manifest['liquid_bam']]
+        # stages of samples preprocessed on the pool are only recorded as part of the preprocess stage
+        with stage('preprocess', samples=len(jobs)):
+            if num_workers > 1:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    samples = list(executor.map(_preprocess_sample, jobs))
+            else:
+                samples = [_preprocess_sample(job) for job in jobs]
+
+        if model in CN_MODELS:
+            samples = [(data, cn_profiles, None) for data, cn_profiles, _ in samples]
+
+        if engine != 'nuts':
+            from src.variational import run_variational
+            # the approximate engines are cheap enough to fit each sample on its own
+            for i, (data, cn_profiles, counts) in enumerate(samples):
+                with stage('inference', engine=engine, bins=len(data), snvs=0 if counts is None else len(counts)):
+                    posterior = run_variational(model, data, cn_profiles, counts, engine, num_samples, svi_steps, learning_rate, int(seed), verbose, compress, thin)
+                with stage('save_results', draws=posterior['tau'].size):
+                    save_results(manifest['output'].iloc[i], posterior, cn_profiles.shape[1]-1, verbose)
+            return
+
+        from src.inference import run_stacked_inference
+        # samples of similar size are batched together to keep padding small
+        order = sorted(range(len(samples)), key=lambda i: (len(samples[i][0]), 0 if samples[i][2] is None else len(samples[i][2])))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            data, cn_profiles, mask, counts, snv_mask = pad_samples([samples[i] for i in batch], pad_buckets)
+            with stage('inference', engine=engine, samples=len(batch), bins=data.shape[1], snvs=0 if counts is None else counts.shape[1]):
+                posteriors = run_stacked_inference(data, cn_profiles, mask, counts, snv_mask, num_samples, num_warmup, int(seed), progress_bar, verbose, num_chains, chain_method, jit_cache_dir, thin)
+
+            for i, posterior in zip(batch, posteriors):
+                _print(f"Sample {manifest['liquid_bam'].iloc[i]}", verbose)
+                with stage('save_results', draws=posterior['tau'].size):
+                    save_results(manifest['output'].iloc[i], posterior, cn_profiles.shape[-1]-1, verbose)
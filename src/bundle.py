@@ -0,0 +1,72 @@
+import io
+import struct
+import zipfile
+import numpy as np
+
+BUNDLE_ARRAYS = ['data', 'cn_profiles', 'counts']
+BUNDLE_DTYPE = np.float32  # jax's default precision, so arrays can be handed over without a conversion (integer
+                           # copy numbers keep their compact dtype)
+ALIGNMENT = 64  # array data starts on this boundary (npy headers are padded to it as well)
+LOCAL_HEADER_SIZE = 30  # fixed part of a zip local file header
+PADDING_HEADER_ID = 0x4c42  # id of the zip extra field used as alignment padding
+
+
+def save_bundle(path, data, cn_profiles, counts=None):
+    """
+    Write preprocessed inputs to an uncompressed .npz bundle whose arrays are aligned so they can be memory mapped
+    (the file is a regular .npz and can also be read with np.load)
+    Arguments:
+        path: a string
+        data: (n,) ndarray
+        cn_profiles: (n, num_clones) ndarray - integer copy numbers are stored with their dtype (ex. uint8)
+        counts: (L, 2+K) ndarray or None
+    """
+    arrays = {'data': data, 'cn_profiles': cn_profiles}
+    if counts is not None:
+        arrays['counts'] = counts
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as bundle:
+        for name, array in arrays.items():
+            buffer = io.BytesIO()
+            array = np.asarray(array)
+            np.lib.format.write_array(buffer, np.ascontiguousarray(array, dtype=array.dtype if array.dtype.kind in 'ui' else BUNDLE_DTYPE))
+            info = zipfile.ZipInfo(f'{name}.npy')
+            # pad the extra field of the local header so the npy member starts on an aligned offset
+            offset = bundle.fp.tell() + LOCAL_HEADER_SIZE + len(info.filename.encode())
+            padding = -(offset + 4) % ALIGNMENT
+            info.extra = struct.pack('<HH', PADDING_HEADER_ID, padding) + b'\0' * padding
+            bundle.writestr(info, buffer.getvalue())
+
+def load_bundle(path):
+    """
+    Memory map the arrays of a bundle written by save_bundle (compressed members of other .npz files are read
+    into memory instead)
+    Arguments:
+        path: a string
+    Returns:
+        Three ndarrays (data, cn_profiles, counts) - counts is None if the bundle has no counts
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as bundle, open(path, 'rb') as f:
+        for info in bundle.infolist():
+            name = info.filename[:-len('.npy')]
+            if name not in BUNDLE_ARRAYS:
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                with bundle.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # the local header's name and extra field lengths can differ from the central directory's
+            f.seek(info.header_offset + LOCAL_HEADER_SIZE - 4)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+
+    missing = {'data', 'cn_profiles'} - set(arrays)
+    if len(missing) > 0:
+        raise RuntimeError(f"Bundle {path} is missing arrays {', '.join(sorted(missing))}")
+    return arrays['data'], arrays['cn_profiles'], arrays.get('counts')
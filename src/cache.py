@@ -0,0 +1,142 @@
+import os
+import hashlib
+import numpy as np
+
+from src.utils import get_random_string, _print
+
+CACHE_DIR = 'cache'  # sub-directory of --temp-dir holding the cached arrays
+INDEX_EXTENSIONS = ['.bai', '.csi', '.tbi']
+
+
+def get_index_path(file_path):
+    """
+    Find the index file of a bam/vcf file
+    Arguments:
+        file_path: a string
+    Returns:
+        Path to the index file or None if the file is not indexed
+    """
+    candidates = [file_path + ext for ext in INDEX_EXTENSIONS] + [os.path.splitext(file_path)[0] + ext for ext in INDEX_EXTENSIONS]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def file_identity(file_path):
+    """
+    Describe a file by its size, modification time and the checksum of its index (if any)
+    Arguments:
+        file_path: a string
+    Returns:
+        Tuple (absolute path, size, mtime in ns, index checksum)
+    """
+    stat = os.stat(file_path)
+    index_path = get_index_path(file_path)
+    index_checksum = None
+    if index_path is not None:
+        with open(index_path, 'rb') as f:
+            index_checksum = hashlib.sha1(f.read()).hexdigest()
+    return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, index_checksum
+
+def array_checksum(*arrays):
+    """
+    Checksum the contents of arrays (for inputs that are not read from a file, ex. preprocessed data)
+    Arguments:
+        arrays: ndarrays (or anything np.asarray accepts)
+    Returns:
+        Hex digest string
+    """
+    checksum = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        checksum.update(repr((array.dtype.str, array.shape)).encode())
+        checksum.update(array.tobytes())
+    return checksum.hexdigest()
+
+def make_key(*parts):
+    """
+    Build a content address from the parts describing a cached result
+    Arguments:
+        parts: objects with a stable repr (strings, numbers, tuples)
+    Returns:
+        Hex digest string
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def get_cache_path(temp_dir, namespace, key):
+    return os.path.join(temp_dir, CACHE_DIR, namespace, f'{key}.npz')
+
+def load_cached(temp_dir, namespace, key):
+    """
+    Load a cached result and mark it as recently used
+    Arguments:
+        temp_dir: a string
+        namespace: a string
+        key: a string
+    Returns:
+        Dictionary of ndarrays or None on a cache miss
+    """
+    path = get_cache_path(temp_dir, namespace, key)
+    if not os.path.exists(path):
+        return None
+    # another process sharing the cache may evict the entry at any point
+    try:
+        with np.load(path) as f:
+            arrays = {name: f[name] for name in f.files}
+        os.utime(path)  # the modification time orders entries for LRU eviction
+    except FileNotFoundError:
+        return None
+    return arrays
+
+def store_cached(temp_dir, namespace, key, arrays, max_size):
+    """
+    Write a result to the cache and evict least recently used entries beyond max_size
+    Arguments:
+        temp_dir: a string
+        namespace: a string
+        key: a string
+        arrays: dictionary of ndarrays
+        max_size: an integer (megabytes)
+    """
+    path = get_cache_path(temp_dir, namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # write to a unique file first so concurrent runs never read a partial entry
+    temp_path = os.path.join(os.path.dirname(path), f'.{key}{get_random_string()}.npz')
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, path)
+
+    evict(temp_dir, max_size)
+
+def evict(temp_dir, max_size):
+    """
+    Delete least recently used cache entries until the cache fits in max_size megabytes
+    Arguments:
+        temp_dir: a string
+        max_size: an integer (megabytes)
+    """
+    entries = []
+    for root, _, files in os.walk(os.path.join(temp_dir, CACHE_DIR)):
+        for name in files:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # evicted by another process sharing the cache
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already evicted by another process
+        total -= size
+
+def clear_cache(temp_dir, verbose):
+    _print('Clearing cache in {}'.format(os.path.join(temp_dir, CACHE_DIR)), verbose)
+    evict(temp_dir, 0)
@@ -1,103 +1,384 @@
 import click
-import src.main
+
+# command modules are imported inside the commands so --help and option parsing don't load the numerical backends
+
+# options describing the inputs and how they are preprocessed (shared by run, batch and prepare)
+input_options = [
+    click.option(
+        '-c', '--cn-profiles-path',
+        type=click.STRING,
+        default=None,
+        help='Path to input .bed file with the copy-number profiles for each clone (not needed for .npz bundles from prepare)'
+    ),
+    click.option(
+        '-b', '--clone-bams',
+        type=click.STRING,
+        default=[''],
+        help='Path to clone bam files (ex. ... -t path_to_clone_1 -t path_to_clone_2 -t path_to_clone_3 ...) - order of clones on the command line must be the same as copy-number profiles (--cn-profiles-path)',
+        multiple=True
+    ),
+    click.option(
+        '-v', '--tissue-vcf',
+        type=click.STRING,
+        default=[''],
+        help='Path to bulk tissue vcf file'
+    ),
+    click.option(
+        '--counts-mat',
+        type=click.STRING,
+        default=None,
+        help='Path to count matrix. Tab delimited.'
+    ),
+    click.option(
+        '-m', '--model',
+        type=click.STRING,
+        default='cn',
+        help='Model type (one of {cn, cn_snv})'
+    ),
+    click.option(
+        '--gc',
+        type=click.STRING,
+        default=None,
+        help='Path to the gc content wig file'
+    ),
+    click.option(
+        '--mapp',
+        type=click.STRING,
+        default=None,
+        help='Path to the mappability wig file'
+    ),
+    click.option(
+        '--chrs',
+        type=click.STRING,
+        default='1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22',
+        help='Chromosomes present in bam file'
+    ),
+    click.option(
+        '--bin-size',
+        type=click.STRING,
+        default='500000',
+        help='Bin size for computing read counts'
+    ),
+    click.option(
+        '--qual',
+        type=click.STRING,
+        default='20',
+        help='Specify the mapping quality value below which reads are ignored'
+    ),
+    click.option(
+        '--verbose',
+        type=click.BOOL,
+        default=False,
+        help='Allow printing'
+    ),
+    click.option(
+        '--temp-dir',
+        type=click.STRING,
+        default='.temp',
+        help='Directory to write dummy files to (must have read and write access to folder)'
+    ),
+    click.option(
+        '--read-counter',
+        type=click.STRING,
+        default='readcounter',
+        help='How binned read counts are computed (one of {readcounter, native}) - native counts reads with pysam and does not need hmmcopy_utils'
+    ),
+    click.option(
+        '--correction',
+        type=click.STRING,
+        default='hmmcopy',
+        help='GC and mappability correction engine (one of {hmmcopy, native}) - native does not need R or the HMMcopy package'
+    ),
+    click.option(
+        '--use-cache',
+        type=click.BOOL,
+        default=True,
+        help='Reuse corrected readcounts cached under --temp-dir from previous runs on the same bam file and settings'
+    ),
+    click.option(
+        '--clear-cache',
+        type=click.BOOL,
+        default=False,
+        help='Delete all cached results under --temp-dir before running'
+    ),
+    click.option(
+        '--cache-size',
+        type=click.INT,
+        default=2048,
+        help='Maximum size of the cache in MB - least recently used entries are evicted beyond it'
+    ),
+    click.option(
+        '--count-cache-dir',
+        type=click.STRING,
+        default=None,
+        help='Directory of a persistent cache of allele counts, shared by runs with different --temp-dir (ex. one per patient) - clone bams are counted once per tissue vcf and reused for every liquid sample. Limited to --cache-size and used even with --use-cache False'
+    ),
+    click.option(
+        '--num-workers',
+        type=click.INT,
+        default=1,
+        help='Number of worker processes used for parallel stages (ex. SNV counting)'
+    ),
+    click.option(
+        '--count-mode',
+        type=click.STRING,
+        default='coverage',
+        help='How allele counts are collected at SNV positions (one of {coverage, pileup}) - pileup sweeps each cluster of SNVs once instead of seeking to every SNV'
+    ),
+]
+
+# options of the inference (shared by run and batch)
+inference_options = [
+    click.option(
+        '-n', '--num-samples',
+        type=click.INT,
+        default=3000,
+        help='Number of samples to draw'
+    ),
+    click.option(
+        '-w', '--num-warmup',
+        type=click.INT,
+        default=100,
+        help='Number of warm up samples to draw'
+    ),
+    click.option(
+        '--thin',
+        type=click.INT,
+        default=1,
+        help='Keep every thin-th posterior draw'
+    ),
+    click.option(
+        '--num-chains',
+        type=click.INT,
+        default=1,
+        help='Number of MCMC chains to run'
+    ),
+    click.option(
+        '--chain-method',
+        type=click.STRING,
+        default='parallel',
+        help='How chains are run (one of {parallel, sequential, vectorized}) - parallel uses one cpu core per chain'
+    ),
+    click.option(
+        '--engine',
+        type=click.STRING,
+        default='nuts',
+        help='Inference engine (one of {nuts, svi, laplace}) - svi and laplace fit an approximate posterior much faster than nuts'
+    ),
+    click.option(
+        '--svi-steps',
+        type=click.INT,
+        default=20000,
+        help='Maximum number of optimisation steps for the svi and laplace engines (stops earlier once the ELBO converges)'
+    ),
+    click.option(
+        '--learning-rate',
+        type=click.FLOAT,
+        default=0.05,
+        help='Adam learning rate for the svi and laplace engines'
+    ),
+    click.option(
+        '--compress',
+        type=click.BOOL,
+        default=True,
+        help='Compress bins with the same copy-number configuration (and SNVs with the same clone coefficients) before inference - same posterior, faster gradients. Not used by the stacked nuts model of the batch command'
+    ),
+    click.option(
+        '--pad-buckets',
+        type=click.BOOL,
+        default=False,
+        help='Pad bins and SNVs up to fixed size buckets (masked out of the likelihood) so inputs of similar size reuse the same compiled sampler'
+    ),
+    click.option(
+        '--jit-cache-dir',
+        type=click.STRING,
+        default=None,
+        help='Directory for the persistent JAX compilation cache - repeated runs with the same input shapes skip compilation'
+    ),
+    click.option(
+        '-s', '--seed',
+        type=click.INT,
+        default=1,
+        help='Seed for pseudo-random functions'
+    ),
+    click.option(
+        '--progress-bar',
+        type=click.BOOL,
+        default=False,
+        help='Show progress bar during inference'
+    ),
+]
+
+# options of the stage profiler (shared by run, batch and prepare)
+profile_options = [
+    click.option(
+        '--profile',
+        type=click.STRING,
+        default=None,
+        help='Path to a JSON file (chrome trace event format) where the wall time, cpu time, peak RSS and sizes of each stage are written to'
+    ),
+    click.option(
+        '--profile-stages',
+        type=click.STRING,
+        default='',
+        help='Comma separated stages to also profile with cProfile (ex. remove_outliers,inference) - stats are written next to --profile as <profile>.<stage>.prof'
+    ),
+]
+
+common_options = input_options + inference_options + profile_options
+
+def add_options(options):
+    def decorator(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+    return decorator
 
 @click.command(name='run')
 @click.option(
     '-i', '--liquid-bam', 
     type=click.STRING,
     required=True,
-    help='Path to liquid bam file'
-)
-@click.option(
-    '-c', '--cn-profiles-path',
-    type=click.STRING,
-    required=True,
-    help='Path to input .bed file with the copy-number profiles for each clone'
+    help='Path to liquid bam file (or .tsv file, or .npz bundle written by prepare)'
 )
 @click.option(
     '-o', '--output',
     type=click.STRING,
     required=True,
-    help='Path to where the output is written to'
+    help='Path to where the posterior draws are written to (format from the extension, one of {.csv, .parquet, .feather, .npz}) - a summary is written next to it (<output>.summary.csv)'
 )
 @click.option(
-    '-b', '--clone-bams',
-    type=click.STRING,
-    default=[''],
-    help='Path to clone bam files (ex. ... -t path_to_clone_1 -t path_to_clone_2 -t path_to_clone_3 ...) - order of clones on the command line must be the same as copy-number profiles (--cn-profiles-path)',
-    multiple=True
+    '--checkpoint-every',
+    type=click.INT,
+    default=0,
+    help='Draw NUTS samples in blocks of this many (500 with --min-ess or --max-rhat) and checkpoint the sampler state to the cache under --temp-dir after every block, so an interrupted run resumes after the last finished block (0 draws all samples in one block)'
 )
 @click.option(
-    '-v', '--tissue-vcf',
-    type=click.STRING,
-    default=[''],
-    help='Path to bulk tissue vcf file'
-)   
-@click.option(
-    '--counts-mat',
-    type=click.STRING,
-    default=None,
-    help='Path to count matrix. Tab delimited.'
+    '--min-ess',
+    type=click.FLOAT,
+    default=0,
+    help='Sample NUTS in blocks until the bulk and tail effective sample size of every parameter reaches this target, with --num-samples as the maximum (0 for no target)'
 )
 @click.option(
-    '-m', '--model',
-    type=click.STRING,
-    default='cn',
-    help='Model type (one of {cn, cn_snv})'
+    '--max-rhat',
+    type=click.FLOAT,
+    default=0,
+    help='Sample NUTS in blocks until the split R-hat of every parameter is at most this target (ex. 1.01), with --num-samples as the maximum (0 for no target)'
 )
 @click.option(
-    '-n', '--num-samples',
+    '--coarse-factor',
     type=click.INT,
-    default=3000,
-    help='Number of samples to draw'
+    default=0,
+    help='Warm start NUTS from a fit to every n-th bin - the coarse fit warms up for --num-warmup draws, the full resolution run starts from its posterior and adaptation and warms up for --fine-warmup draws (0 warms up from scratch)'
 )
 @click.option(
-    '-w', '--num-warmup',
+    '--fine-warmup',
     type=click.INT,
-    default=100,
-    help='Number of warm up samples to draw'
+    default=50,
+    help='Number of warm up samples of the full resolution run with --coarse-factor'
+)
+@add_options(common_options)
+def run(**kwargs):
+    """ Fit LiquidBayes model to data.
+    """
+    import src.main
+    src.main.run(**kwargs)
+
+@click.command(name='batch')
+@click.option(
+    '--manifest',
+    type=click.STRING,
+    required=True,
+    help='Tab delimited file with a header and one liquid sample per row - columns liquid_bam (path to liquid bam, .tsv file or .npz bundle) and output (path to where the output is written to, see run --output)'
 )
 @click.option(
-    '-s', '--seed',
+    '--batch-size',
     type=click.INT,
     default=1,
-    help='Seed for pseudo-random functions'
+    help='Number of samples fitted together by one NUTS run (samples are padded to the same number of bins)'
 )
+@add_options(common_options)
+def batch(**kwargs):
+    """ Fit LiquidBayes model to many liquid samples with the same copy-number profiles.
+    """
+    import src.batch
+    src.batch.run_batch(**kwargs)
+
+@click.command(name='prepare')
 @click.option(
-    '--gc',
+    '-i', '--liquid-bam',
     type=click.STRING,
-    default=None,
-    help='Path to the gc content wig file'
+    required=True,
+    help='Path to liquid bam file'
 )
 @click.option(
-    '--mapp',
+    '-o', '--output',
     type=click.STRING,
-    default=None,
-    help='Path to the mappability wig file'
+    required=True,
+    help='Path to where the .npz bundle is written to'
 )
+@add_options(input_options + profile_options)
+def prepare(**kwargs):
+    """ Preprocess inputs once into a .npz bundle that run and batch accept in place of a liquid bam.
+    """
+    import src.main
+    src.main.prepare(**kwargs)
+
+@click.command(name='profile-startup')
 @click.option(
-    '--progress-bar',
-    type=click.BOOL,
-    default=False,
-    help='Show progress bar during inference'
+    '--modules',
+    type=click.STRING,
+    default='src.cli,src.main,src.preprocessing,src.process_snvs,src.inference,src.output',
+    help='Comma separated modules to time'
 )
 @click.option(
-    '--chrs',
+    '--top',
+    type=click.INT,
+    default=8,
+    help='Number of slowest imports listed per module'
+)
+def profile_startup(modules, top):
+    """ Report the import time of the command modules and their heaviest dependencies.
+    """
+    import src.profiling
+    src.profiling.profile_startup(modules.split(','), top)
+
+@click.command(name='serve')
+@click.option(
+    '--socket',
     type=click.STRING,
-    default='1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22',
-    help='Chromosomes present in bam file'
+    default=None,
+    help='Path of a Unix socket to listen on (by default the server listens on --port of localhost)'
+)
+@click.option(
+    '--port',
+    type=click.INT,
+    default=8765,
+    help='Localhost port to listen on'
+)
+@click.option(
+    '--num-workers',
+    type=click.INT,
+    default=2,
+    help='Number of worker processes - each runs one job at a time'
+)
+@click.option(
+    '--num-chains',
+    type=click.INT,
+    default=1,
+    help='Largest number of parallel chains of a job (see run --num-chains) - workers are started with a cpu device per chain'
 )
 @click.option(
-    '--bin-size',
+    '--jobs-dir',
     type=click.STRING,
-    default='500000',
-    help='Bin size for computing read counts'
+    default='.temp/jobs',
+    help='Directory the stage trace of each job is written to (see run --profile)'
 )
 @click.option(
-    '--qual',
+    '--preload',
     type=click.STRING,
-    default='20',
-    help='Specify the mapping quality value below which reads are ignored'
+    default='jax,pysam,hmmcopy',
+    help='Comma separated backends every worker loads at startup (any of {jax, pysam, hmmcopy}) - backends that are not installed are skipped'
 )
 @click.option(
     '--verbose',
@@ -105,19 +386,26 @@ import src.main
     default=False,
     help='Allow printing'
 )
-@click.option(
-    '--temp-dir',
-    type=click.STRING,
-    default='.temp',
-    help='Directory to write dummy files to (must have read and write access to folder)'
-)
-def run(**kwargs):
-    """ Fit LiquidBayes model to data.
+def serve(**kwargs):
+    """ Run jobs with the parameters of run on a pool of warm workers, submitted over HTTP.
     """
-    src.main.run(**kwargs)
+    import src.serve
+    src.serve.serve(**kwargs)
+
+class DefaultGroup(click.Group):
+    """ Group that falls back to the run command, so `liquid-bayes -i ... -o ...` keeps working.
+    """
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args = ['run'] + list(args)
+        return super().parse_args(ctx, args)
 
-@click.group(name='liquid-bayes')
+@click.group(name='liquid-bayes', cls=DefaultGroup)
 def main():
     pass
 
 main.add_command(run)
+main.add_command(batch)
+main.add_command(prepare)
+main.add_command(profile_startup)
+main.add_command(serve)
@@ -0,0 +1,113 @@
+import numpy as np
+from scipy.stats import norm, rankdata
+from numpyro.diagnostics import effective_sample_size, gelman_rubin
+
+TAIL_PROB = 0.05  # tail ESS is computed for the 5% and 95% quantiles
+
+
+def split_chains(draws):
+    """
+    Split each chain in two halves (the middle draw of odd length chains is dropped)
+    Arguments:
+        draws: (num_chains, num_draws) ndarray
+    Returns:
+        (2*num_chains, num_draws//2) ndarray
+    """
+    half = draws.shape[1] // 2
+    return np.concatenate([draws[:, :half], draws[:, draws.shape[1] - half:]], axis=0)
+
+def rank_normalize(draws):
+    """
+    Replace draws by the normal scores of their ranks over all chains
+    Arguments:
+        draws: (num_chains, num_draws) ndarray
+    Returns:
+        ndarray with the shape of draws
+    """
+    ranks = rankdata(draws, axis=None).reshape(draws.shape)
+    return norm.ppf((ranks - 3 / 8) / (draws.size + 1 / 4))
+
+def _ess(draws):
+    # constant draws (ex. a tail indicator that is never hit) have no defined ESS
+    if np.ptp(draws) == 0:
+        return np.nan
+    return float(effective_sample_size(split_chains(draws)))
+
+def bulk_ess(draws):
+    """
+    Bulk effective sample size - ESS of the rank normalised split chains (Vehtari et al. 2021)
+    Arguments:
+        draws: (num_chains, num_draws) ndarray
+    Returns:
+        A float
+    """
+    return _ess(rank_normalize(draws))
+
+def tail_ess(draws, prob=TAIL_PROB):
+    """
+    Tail effective sample size - the smaller ESS of the indicators of the prob and 1-prob quantiles
+    Arguments:
+        draws: (num_chains, num_draws) ndarray
+        prob: a float
+    Returns:
+        A float
+    """
+    lower, upper = np.quantile(draws, [prob, 1 - prob])
+    return float(np.min([_ess((draws <= lower).astype(float)), _ess((draws <= upper).astype(float))]))
+
+def r_hat(draws):
+    """
+    Rank normalised split R-hat - the larger of the R-hats of the draws and of their distance to the median
+    (which catches chains that differ in scale rather than location)
+    Arguments:
+        draws: (num_chains, num_draws) ndarray
+    Returns:
+        A float
+    """
+    folded = np.abs(draws - np.median(draws))
+    return max(float(gelman_rubin(split_chains(rank_normalize(draws)))), float(gelman_rubin(split_chains(rank_normalize(folded)))))
+
+def diagnose(draws):
+    """
+    Arguments:
+        draws: (num_chains, num_draws) ndarray - at least 4 draws per chain
+    Returns:
+        Dictionary with the bulk ESS, tail ESS and R-hat of draws
+    """
+    draws = np.asarray(draws, dtype=float)
+    return {'ess_bulk': bulk_ess(draws), 'ess_tail': tail_ess(draws), 'r_hat': r_hat(draws)}
+
+def get_parameters(samples):
+    """
+    Split posterior draws into scalar parameters - one per entry of rho, plus tau
+    Arguments:
+        samples: dictionary with sites rho and tau - each of shape (num_chains, num_draws, ...)
+    Returns:
+        Dictionary mapping (site, index) to (num_chains, num_draws) ndarrays
+    """
+    rho = np.asarray(samples['rho'])
+    parameters = {('rho', i): rho[..., i] for i in range(rho.shape[-1])}
+    parameters[('tau', None)] = np.asarray(samples['tau']).reshape(rho.shape[:2])
+    return parameters
+
+def check_convergence(samples, min_ess, max_rhat):
+    """
+    Check whether every parameter has reached the ESS and R-hat targets (NaN diagnostics count as not reached)
+    Arguments:
+        samples: dictionary with sites rho and tau - each of shape (num_chains, num_draws, ...)
+        min_ess: a float - minimum bulk and tail ESS (0 for no target)
+        max_rhat: a float - maximum R-hat (0 for no target)
+    Returns:
+        A boolean and a dictionary with the smallest ESS and largest R-hat over the parameters
+    """
+    diagnostics = [diagnose(draws) for draws in get_parameters(samples).values()]
+    # np.min and np.max propagate NaN, so undefined diagnostics never meet a target
+    worst = {'ess_bulk': np.min([d['ess_bulk'] for d in diagnostics]),
+             'ess_tail': np.min([d['ess_tail'] for d in diagnostics]),
+             'r_hat': np.max([d['r_hat'] for d in diagnostics])}
+    converged = True
+    if min_ess > 0:
+        converged &= bool(worst['ess_bulk'] >= min_ess and worst['ess_tail'] >= min_ess)
+    if max_rhat > 0:
+        converged &= bool(worst['r_hat'] <= max_rhat)
+    return converged, worst
@@ -1,11 +1,183 @@
+import os
+import pickle
+from functools import partial
 import numpy as np
 import numpyro
-from numpyro.infer import MCMC, NUTS
+from numpyro.infer import MCMC, NUTS, init_to_value
+import jax
 from jax import random
 
-from src.utils import _print
-from src.models import base, extended
+from src.cache import array_checksum, make_key, load_cached, store_cached
+from src.utils import CN_MODELS, _print, group_rows
+from src.models import base, extended, compressed_base, compressed_extended, stacked
 
+ADAPTIVE_BLOCK_SIZE = 500  # draws per block when sampling until convergence targets are met
+COARSE_SAMPLES = 200  # draws of the coarse fit of fit_coarse, their medians are the initial values of the fine run
+CHECKPOINT_VERSION = 1  # bump when the models or sampling change, so checkpointed draws are not resumed from
+FLOAT_DTYPE = np.float32  # jax runs in single precision (x64 is never enabled), so inputs are converted once on the host
+
+# compiled samplers reused across calls with the same model, settings and input shapes
+_samplers = {}
+
+
+def setup_chains(num_chains, chain_method, verbose):
+    """
+    Make one XLA host device available per chain (up to the number of cores) so parallel chains run concurrently.
+    Only has an effect if JAX has not initialised its backend yet
+    Arguments:
+        num_chains: an integer
+        chain_method: a string (one of {parallel, sequential, vectorized})
+        verbose: a boolean
+    """
+    if chain_method not in ['parallel', 'sequential', 'vectorized']:
+        raise RuntimeError(f"Unknown chain method {chain_method} (must be one of parallel, sequential, vectorized)")
+
+    if chain_method == 'parallel' and num_chains > 1:
+        num_devices = min(num_chains, os.cpu_count() or 1)
+        _print(f'Running {num_chains} chains on {num_devices} cpu devices', verbose)
+        numpyro.set_host_device_count(num_devices)
+
+def setup_jit_cache(jit_cache_dir, verbose):
+    """
+    Enable JAX's persistent compilation cache so compiled NUTS kernels are reused across runs
+    Arguments:
+        jit_cache_dir: a string or None (cache disabled)
+        verbose: a boolean
+    """
+    if jit_cache_dir is None:
+        return
+    _print(f'Using compilation cache in {jit_cache_dir}', verbose)
+    os.makedirs(jit_cache_dir, exist_ok=True)
+    jax.config.update('jax_compilation_cache_dir', jit_cache_dir)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+
+def bucket_size(n):
+    """
+    Round n up to a coarse size bucket - a multiple of 1/8 of the power of two below n, so padding adds at most 12.5%
+    Arguments:
+        n: an integer
+    Returns:
+        An integer >= n
+    """
+    if n <= 8:
+        return max(n, 1)
+    step = 2 ** (int(np.floor(np.log2(n))) - 3)
+    return int(-(-n // step) * step)
+
+def pad_to(array, size, fill=0):
+    """
+    Pad the first axis of array to size
+    Returns:
+        The padded ndarray and a boolean mask that is False for padding rows
+    """
+    padded = np.full((size,) + array.shape[1:], fill, dtype=np.result_type(array, fill))
+    padded[:len(array)] = array
+    mask = np.zeros(size, dtype=bool)
+    mask[:len(array)] = True
+    return padded, mask
+
+def compress_inputs(cn_profiles, counts=None):
+    """
+    Compress bins to their unique copy-number configurations and SNVs to their unique clone coefficients
+    Arguments:
+        cn_profiles: (n, num_clones) ndarray
+        counts: (L, 2+K) ndarray or None
+    Returns:
+        Tuple (configs, config_idx, weights) plus (snv_coefs, snv_alt, snv_depth) if counts is not None
+    """
+    configs, config_idx = group_rows(cn_profiles)
+    config_idx = config_idx.astype(np.int32)
+    weights = np.bincount(config_idx, minlength=len(configs)).astype(FLOAT_DTYPE)
+    if counts is None:
+        return configs, config_idx, weights
+
+    # the binomial likelihood of SNVs sharing a success probability depends only on their summed alt counts and
+    # depths (up to a constant), so SNVs are aggregated by their clone coefficients alone
+    snv_coefs, snv_idx = group_rows(counts[:, 2:])
+    snv_alt = np.bincount(snv_idx, weights=counts[:, 1], minlength=len(snv_coefs))
+    snv_depth = np.bincount(snv_idx, weights=np.sum(counts[:, :2], axis=1), minlength=len(snv_coefs))
+    return configs, config_idx, weights, snv_coefs, snv_alt.astype(FLOAT_DTYPE), snv_depth.astype(FLOAT_DTYPE)
+
+def get_model(model, data, cn_profiles, counts, compress=False):
+    """
+    Map a model name to its numpyro model and positional arguments. data and counts are converted to FLOAT_DTYPE,
+    integer copy numbers keep their compact dtype (the models promote them to floats on the device)
+    Arguments:
+        compress: a boolean - use the compressed counterpart of the model (see compress_inputs)
+    Returns:
+        Tuple (model function, model arguments) - num_clones is the last argument
+    """
+    num_clones = cn_profiles.shape[1]
+    data = np.asarray(data, dtype=FLOAT_DTYPE)
+    if counts is not None:
+        counts = np.asarray(counts, dtype=FLOAT_DTYPE)
+    if model in CN_MODELS:
+        if compress:
+            return compressed_base, (data,) + compress_inputs(cn_profiles) + (num_clones,)
+        return base, (data, cn_profiles, num_clones)
+    elif model in ['extended', 'cn_snv']:
+        if compress:
+            return compressed_extended, (data,) + compress_inputs(cn_profiles, counts) + (num_clones,)
+        return extended, (data, cn_profiles, counts, num_clones)
+    raise RuntimeError(f"Unknown model {model} (must be one of cn, cn_snv)")
+
+def pad_model_args(model_fn, model_args):
+    """
+    Pad the bins (and SNVs) of the arguments of model_fn to bucket sizes - padding rows of cn_profiles and configs
+    are ones so the log of the clone mixture stays finite
+    Arguments:
+        model_fn: one of the models returned by get_model
+        model_args: tuple of arguments returned by get_model
+    Returns:
+        Tuple (padded arguments without num_clones, dictionary of mask keyword arguments)
+    """
+    data, *inputs = model_args[:-1]
+    padded_data, mask = pad_to(data, bucket_size(len(data)))
+
+    if model_fn in [base, extended]:
+        args = (padded_data, pad_to(inputs[0], len(padded_data), fill=1)[0])
+        if model_fn is base:
+            return args, {'mask': mask}
+        padded_counts, snv_mask = pad_to(inputs[1], bucket_size(len(inputs[1])))
+        return args + (padded_counts,), {'mask': mask, 'snv_mask': snv_mask}
+
+    configs, config_idx, weights = inputs[:3]
+    num_configs = bucket_size(len(configs))
+    args = (padded_data, pad_to(configs, num_configs, fill=1)[0], pad_to(config_idx, len(padded_data))[0], pad_to(weights, num_configs)[0])
+    if model_fn is compressed_base:
+        return args, {'mask': mask}
+    snv_coefs, snv_alt, snv_depth = inputs[3:]
+    num_rows = bucket_size(len(snv_coefs))
+    padded_coefs, snv_mask = pad_to(snv_coefs, num_rows)
+    return args + (padded_coefs, pad_to(snv_alt, num_rows)[0], pad_to(snv_depth, num_rows)[0]), {'mask': mask, 'snv_mask': snv_mask}
+
+def fit_coarse(model, data, cn_profiles, counts, coarse_factor, num_warmup, iteration, progress_bar, verbose, num_chains, chain_method, compress):
+    """
+    Fit the model to every coarse_factor-th bin (and SNV) and turn the result into a warm start for the fine
+    resolution run. The coarse bins keep their own log-ratios, so rho and tau mean the same in both fits and only
+    the amount of data differs - the posterior variance shrinks in proportion to it, so the adapted inverse mass
+    matrix is scaled down by the fraction of bins kept
+    Returns:
+        Dictionary of NUTS arguments - step_size, inverse_mass_matrix, adapt_mass_matrix and an init_strategy
+        starting rho and tau at their coarse posterior medians
+    """
+    coarse_data = data[::coarse_factor]
+    _print(f'Fitting {len(coarse_data)} of {len(data)} bins to warm start the sampler', verbose)
+    model_fn, model_args = get_model(model, coarse_data, cn_profiles[::coarse_factor], None if counts is None else counts[::coarse_factor], compress)
+    sampler_obj = MCMC(NUTS(model_fn), num_warmup=num_warmup, num_samples=COARSE_SAMPLES, num_chains=num_chains,
+                       chain_method=chain_method, progress_bar=progress_bar)
+    sampler_obj.run(random.PRNGKey(iteration), *model_args)
+    adapt_state = jax.device_get(sampler_obj.last_state.adapt_state)
+    samples = jax.device_get(sampler_obj.get_samples())
+    rho = np.median(samples['rho'], axis=0)
+
+    # the mass matrix maps tuples of sites to their diagonal (with a leading axis if chains adapted separately) -
+    # the fine run starts every chain from the average and only adapts its step size
+    fraction = len(coarse_data) / len(data)
+    return {'step_size': float(np.mean(adapt_state.step_size)),
+            'inverse_mass_matrix': {sites: np.reshape(diagonal, (-1, diagonal.shape[-1])).mean(axis=0) * fraction for sites, diagonal in adapt_state.inverse_mass_matrix.items()},
+            'adapt_mass_matrix': False,
+            'init_strategy': init_to_value(values={'rho': rho / np.sum(rho), 'tau': np.median(samples['tau'])})}
 
 def run_inference(model,
                   data,
@@ -16,21 +188,207 @@ def run_inference(model,
                   iteration,
                   progress_bar,
                   verbose,
-                  target_accept_prob=0.95):
-
+                  num_chains=1,
+                  chain_method='parallel',
+                  pad_buckets=False,
+                  jit_cache_dir=None,
+                  compress=False,
+                  thin=1,
+                  target_accept_prob=0.95,
+                  checkpoint_every=0,
+                  temp_dir=None,
+                  cache_size=2048,
+                  min_ess=0,
+                  max_rhat=0,
+                  coarse_factor=0,
+                  fine_warmup=50):
+    """
+    Fit a model with NUTS
+    Arguments:
+        checkpoint_every: an integer - draw the samples in blocks of this many (0 for a single block), each block
+            continuing from the last state of the previous one
+        temp_dir: a string or None - checkpoint the sampler state and draws to the cache in temp_dir after every
+            block, so a rerun with the same inputs and settings resumes after the last finished block
+        cache_size: an integer (megabytes)
+        min_ess: a float - stop after the first block where the bulk and tail ESS of every parameter reach min_ess
+            (0 for no target), num_samples is then the maximum number of draws
+        max_rhat: a float - stop once the R-hat of every parameter is at most max_rhat (0 for no target)
+        coarse_factor: an integer - first fit every coarse_factor-th bin with num_warmup warm up draws, then start
+            the fine resolution run from the coarse posterior and adaptation with fine_warmup warm up draws (see
+            fit_coarse, 0 to warm up from scratch)
+        fine_warmup: an integer
+    Returns:
+        Dictionary with sites rho and tau, each of shape (num_chains, num_draws, ...)
+    """
     _print('Performing inference using {} model'.format(model), verbose)
-    if model == 'base':
-        sampler_obj = numpyro.infer.MCMC(numpyro.infer.NUTS(base),
-                                         num_warmup=num_warmup,
-                                         num_samples=num_samples,
-                                         progress_bar=progress_bar)
-        sampler_obj.run(random.PRNGKey(iteration), data, cn_profiles, cn_profiles.shape[1])
-        return sampler_obj
+    setup_jit_cache(jit_cache_dir, verbose)
+    setup_chains(num_chains, chain_method, verbose)
+    num_clones = cn_profiles.shape[1]
+
+    model_fn, model_args = get_model(model, data, cn_profiles, counts, compress)
+
+    # blocks hold a multiple of thin draws so thinning is the same as in a single block
+    adaptive = min_ess > 0 or max_rhat > 0
+    if checkpoint_every <= 0:
+        checkpoint_every = ADAPTIVE_BLOCK_SIZE if adaptive else num_samples
+    block_size = min(num_samples, -(-checkpoint_every // thin) * thin)
+    num_blocks = -(-num_samples // block_size)
+
+    model_kwargs = {}
+    sampler_fn = model_fn
+    if pad_buckets:
+        # pad bins (and SNVs) to bucket sizes and mask the padding out of the likelihood, so inputs of similar size
+        # share one compiled kernel - num_clones is bound to the model as it has to stay static
+        model_args, model_kwargs = pad_model_args(model_fn, model_args)
+        sampler_fn = partial(model_fn, num_clones=num_clones)
+        _print(f'Padded {len(data)} bins to {len(model_args[0])}', verbose)
 
-    if model == 'extended':
-        sampler_obj = numpyro.infer.MCMC(numpyro.infer.NUTS(extended),
-                                         num_warmup=num_warmup,
-                                         num_samples=num_samples,
+    checkpoint_key, checkpoint = None, None
+    if temp_dir is not None:
+        checkpoint_key = make_key(model_fn.__name__, array_checksum(*model_args, *model_kwargs.values()), num_samples, num_warmup,
+                                  iteration, num_chains, chain_method, thin, block_size, coarse_factor > 1 and (coarse_factor, fine_warmup),
+                                  CHECKPOINT_VERSION)
+        checkpoint = load_cached(temp_dir, 'mcmc', checkpoint_key)
+    # the targets are left out of the checkpoint key - blocks do not depend on them, so a run with a stricter
+    # target continues from the checkpoint of a looser one
+
+    warm_start, warmup = {}, num_warmup
+    if coarse_factor > 1:
+        # a checkpoint holds the state adapted in the first block, so a resumed run does not need the coarse fit
+        if checkpoint is None:
+            warm_start = fit_coarse(model, data, cn_profiles, counts, coarse_factor, num_warmup, iteration, progress_bar, verbose, num_chains, chain_method, compress)
+        warmup = fine_warmup
+
+    if pad_buckets and len(warm_start) == 0:
+        key = (model_fn.__name__, tuple(arg.shape for arg in model_args), num_clones, block_size, warmup, progress_bar, num_chains, chain_method, thin)
+        sampler_obj = get_sampler(key, sampler_fn, block_size, warmup, progress_bar, num_chains, chain_method, thin)
+    else:
+        # warm started kernels are not shared - their step size and mass matrix are baked in
+        sampler_obj = numpyro.infer.MCMC(numpyro.infer.NUTS(sampler_fn, **warm_start),
+                                         num_warmup=warmup,
+                                         num_samples=block_size,
+                                         num_chains=num_chains,
+                                         chain_method=chain_method,
+                                         thinning=thin,
                                          progress_bar=progress_bar)
-        sampler_obj.run(random.PRNGKey(iteration), data, cn_profiles, counts, cn_profiles.shape[1])
-        return sampler_obj
+
+    converged = partial(check_targets, min_ess=min_ess, max_rhat=max_rhat, verbose=verbose) if adaptive else None
+    samples = run_blocks(sampler_obj, random.PRNGKey(iteration), model_args, model_kwargs, num_blocks, temp_dir, checkpoint_key, checkpoint, cache_size, verbose, converged)
+    return {name: site[:, :num_samples // thin] for name, site in samples.items()}
+
+def check_targets(samples, min_ess, max_rhat, verbose):
+    """
+    Check the draws so far against the convergence targets of run_inference and report their diagnostics
+    Returns:
+        A boolean
+    """
+    from src.diagnostics import check_convergence
+    converged, worst = check_convergence(samples, min_ess, max_rhat)
+    _print(f"{samples['tau'].shape[1]} draws per chain - smallest bulk ESS {worst['ess_bulk']:.0f}, smallest tail ESS {worst['ess_tail']:.0f}, "
+           f"largest R-hat {worst['r_hat']:.3f}{' (targets met)' if converged else ''}", verbose)
+    return converged
+
+def run_blocks(sampler_obj, rng_key, model_args, model_kwargs, num_blocks, temp_dir, key, checkpoint, cache_size, verbose, converged=None):
+    """
+    Run the sampler num_blocks times - warm up only runs in the first block, the others continue from the last
+    state of the previous block. With temp_dir the state and the draws so far are written to the cache after every
+    block, and sampling resumes from checkpoint if given
+    Arguments:
+        sampler_obj: numpyro.infer.MCMC
+        rng_key: a PRNGKey
+        model_args: tuple of model arguments
+        model_kwargs: dictionary of model keyword arguments
+        num_blocks: an integer
+        temp_dir: a string or None (no checkpoints)
+        key: a string - cache key of the checkpoint
+        checkpoint: dictionary or None - the cache entry of key loaded by the caller (None to start from scratch)
+        cache_size: an integer (megabytes)
+        verbose: a boolean
+        converged: a function of the draws so far or None - no more blocks are run once it returns True
+    Returns:
+        Dictionary of draws, each of shape (num_chains, num_draws, ...)
+    """
+    state, samples, first_block = None, None, 0
+    if checkpoint is not None:
+        state = pickle.loads(checkpoint.pop('state').tobytes())
+        first_block = int(checkpoint.pop('num_blocks'))
+        samples = checkpoint
+        _print(f'Resuming sampling from a checkpoint after {first_block} of {num_blocks} blocks', verbose)
+
+    try:
+        for block in range(first_block, num_blocks):
+            if samples is not None and converged is not None and converged(samples):
+                break
+            sampler_obj.post_warmup_state = state
+            sampler_obj.run(rng_key if block == 0 else random.fold_in(rng_key, block), *model_args, **model_kwargs)
+            state = jax.device_get(sampler_obj.last_state)
+            draws = jax.device_get(sampler_obj.get_samples(group_by_chain=True))
+            samples = draws if samples is None else {name: np.concatenate([samples[name], site], axis=1) for name, site in draws.items()}
+
+            if temp_dir is not None:
+                _print(f'Checkpointing block {block + 1} of {num_blocks}', verbose and num_blocks > 1)
+                store_cached(temp_dir, 'mcmc', key, {**samples, 'state': np.frombuffer(pickle.dumps(state), dtype=np.uint8), 'num_blocks': block + 1}, cache_size)
+        else:
+            if converged is not None and not converged(samples):
+                _print('Convergence targets not met within the maximum number of draws', verbose)
+    finally:
+        sampler_obj.post_warmup_state = None  # samplers from get_sampler are shared with later calls
+    return samples
+
+def get_sampler(key, model_fn, num_samples, num_warmup, progress_bar, num_chains, chain_method, thin=1):
+    """
+    Get an MCMC object whose compiled NUTS kernel is shared by all calls with the same key. Model arguments are
+    passed to the compiled function instead of being baked in, so new data with the same shapes does not recompile
+    Arguments:
+        key: a hashable describing the model and input shapes
+        model_fn: a numpyro model
+    Returns:
+        numpyro.infer.MCMC
+    """
+    if key not in _samplers:
+        _samplers[key] = numpyro.infer.MCMC(numpyro.infer.NUTS(model_fn),
+                                            num_warmup=num_warmup,
+                                            num_samples=num_samples,
+                                            num_chains=num_chains,
+                                            chain_method=chain_method,
+                                            thinning=thin,
+                                            progress_bar=progress_bar,
+                                            jit_model_args=True)
+    return _samplers[key]
+
+def run_stacked_inference(data,
+                          cn_profiles,
+                          mask,
+                          counts,
+                          snv_mask,
+                          num_samples,
+                          num_warmup,
+                          iteration,
+                          progress_bar,
+                          verbose,
+                          num_chains=1,
+                          chain_method='parallel',
+                          jit_cache_dir=None,
+                          thin=1):
+    """
+    Fit the stacked model to several padded liquid samples at once. The posterior factorises over samples, so this
+    is equivalent to fitting each sample on its own (the samples share the NUTS step size and trajectory length)
+    Arguments:
+        data: (S, n) ndarray
+        cn_profiles: (S, n, num_clones) ndarray
+        mask: (S, n) boolean ndarray
+        counts: (S, L, 2+K) ndarray or None
+        snv_mask: (S, L) boolean ndarray or None
+    Returns:
+        List of S dictionaries with sites rho and tau, each of shape (num_chains, num_draws, ...)
+    """
+    _print(f'Performing inference on {data.shape[0]} stacked samples with {data.shape[1]} bins', verbose)
+    setup_jit_cache(jit_cache_dir, verbose)
+    setup_chains(num_chains, chain_method, verbose)
+
+    key = ('stacked', data.shape, None if counts is None else counts.shape, num_samples, num_warmup, progress_bar, num_chains, chain_method, thin)
+    sampler_obj = get_sampler(key, stacked, num_samples, num_warmup, progress_bar, num_chains, chain_method, thin)
+    sampler_obj.run(random.PRNGKey(iteration), data, cn_profiles, mask, counts, snv_mask)
+
+    samples = sampler_obj.get_samples(group_by_chain=True)
+    return [{'rho': samples['rho'][:, :, i, 0], 'tau': samples['tau'][:, :, i, 0]} for i in range(data.shape[0])]
@@ -1,7 +1,178 @@
-from src.inference import run_inference
-from src.preprocessing import remove_outliers, get_reads, preprocess_bam_file
-from src.process_snvs import get_counts, process_counts
-from src.utils import save_results, _print, get_extension, load_data, load_counts
+import os
+
+from src.bundle import save_bundle, load_bundle
+from src.cache import clear_cache as clear_cached, make_key, file_identity, load_cached, store_cached
+from src.preprocessing import remove_outliers, preprocess_bam_file
+from src.output import save_results
+from src.profiling import profiled, stage
+from src.utils import CN_MODELS, _print, get_extension, load_data, load_counts
+
+# process_snvs (pysam), inference and variational (jax, numpyro) are imported by the code paths that use them
+
+BINS_CACHE_VERSION = 2  # bump when the cached bins change, so they are not reused (2: int32 bins and compact copy numbers)
+PROCESSED_COUNTS_CACHE_VERSION = 1  # bump when the cached processed counts change (1: indels and MNPs dropped)
+
+
+def get_count_cache_dir(count_cache_dir, temp_dir, use_cache):
+    """
+    Returns:
+        Directory whose cache holds allele counts of bam files - count_cache_dir if given (used even without
+        use_cache), otherwise temp_dir if use_cache, otherwise None
+    """
+    if count_cache_dir is not None:
+        return count_cache_dir
+    return temp_dir if use_cache else None
+
+
+def clear_caches(temp_dir, count_cache_dir, verbose):
+    clear_cached(temp_dir, verbose)
+    if count_cache_dir is not None:
+        clear_cached(count_cache_dir, verbose)
+
+
+def preprocess(liquid_bam,
+               cn_profiles_path,
+               clone_bams,
+               tissue_vcf,
+               counts_mat,
+               model,
+               gc,
+               mapp,
+               chrs,
+               bin_size,
+               qual,
+               verbose,
+               temp_dir,
+               num_workers,
+               count_mode,
+               use_cache,
+               cache_size,
+               correction,
+               read_counter,
+               count_cache_dir=None):
+    """
+    Load and preprocess the inputs of one liquid sample (.npz bundles written by prepare are already preprocessed)
+    Returns:
+        Three ndarrays (data, cn_profiles, counts) ready for run_inference - counts is None for the cn model
+    """
+    if get_extension(liquid_bam) == '.npz':
+        _print('Loading preprocessed inputs from {}'.format(liquid_bam), verbose)
+        with stage('load_bundle') as info:
+            data, cn_profiles, counts = load_bundle(liquid_bam)
+            info['bins'] = len(data)
+            info['snvs'] = 0 if counts is None else len(counts)
+        return data, cn_profiles, counts
+    if cn_profiles_path is None:
+        raise RuntimeError("Must specify the copy-number profiles (--cn-profiles-path)")
+
+    # bins and counts are cached after outlier removal and process_counts, so reruns skip all preprocessing
+    bins_key = make_key(file_identity(liquid_bam), file_identity(cn_profiles_path), chrs, bin_size, qual,
+                        gc and os.path.abspath(gc), mapp and os.path.abspath(mapp), correction, read_counter, BINS_CACHE_VERSION)
+    cached = load_cached(temp_dir, 'bins', bins_key) if use_cache else None
+    if cached is not None:
+        _print('Loading preprocessed bins from cache', verbose)
+        data, bins, cn_profiles = cached['data'], cached['bins'], cached['cn_profiles']
+    else:
+        # load data and preprocess
+        if get_extension(liquid_bam) == '.tsv':
+            with stage('load_data') as info:
+                raw_data, raw_bins, raw_cn_profiles = load_data(liquid_bam, cn_profiles_path)
+                info['bins'] = len(raw_data)
+        elif get_extension(liquid_bam) == '.bam':
+            raw_data, raw_bins, raw_cn_profiles = preprocess_bam_file(liquid_bam, cn_profiles_path, chrs, bin_size, qual, gc, mapp, verbose, temp_dir, use_cache, cache_size, correction, read_counter, num_workers)
+
+        with stage('remove_outliers', bins=len(raw_data)) as info:
+            data, bins, cn_profiles = remove_outliers(raw_data, raw_bins, raw_cn_profiles, verbose)
+            info['bins_kept'] = len(data)
+            info['bins_dropped'] = len(raw_data) - len(data)
+
+        if use_cache:
+            store_cached(temp_dir, 'bins', bins_key, {'data': data, 'bins': bins, 'cn_profiles': cn_profiles}, cache_size)
+
+    # get counts at SNV locations if applicable
+    if counts_mat is not None:
+        with stage('load_counts') as info:
+            counts = load_counts(counts_mat)
+            info['snvs'] = len(counts)
+    elif clone_bams == ('',) and tissue_vcf == ('',) or model in CN_MODELS:
+        counts = None
+    else:
+        counts_key = make_key(bins_key, [file_identity(clone_bam) for clone_bam in clone_bams], file_identity(tissue_vcf), count_mode,
+                              PROCESSED_COUNTS_CACHE_VERSION)
+        cached = load_cached(temp_dir, 'counts', counts_key) if use_cache else None
+        if cached is not None:
+            _print('Loading processed counts from cache', verbose)
+            counts = cached['counts']
+        else:
+            from src.process_snvs import get_counts_parallel, process_counts
+            with stage('get_counts', bams=1 + len(clone_bams), count_mode=count_mode) as info:
+                counts_liquid, *counts_clones = get_counts_parallel([liquid_bam] + list(clone_bams), tissue_vcf, num_workers, verbose, count_mode,
+                                                                    get_count_cache_dir(count_cache_dir, temp_dir, use_cache), cache_size)
+                info['snvs'] = len(counts_liquid)
+            with stage('process_counts', snvs=len(counts_liquid)) as info:
+                counts = process_counts(counts_liquid, counts_clones, bins, cn_profiles, verbose)
+                info['snvs_kept'] = len(counts)
+                info['snvs_filtered'] = len(counts_liquid) - len(counts)
+            if use_cache:
+                store_cached(temp_dir, 'counts', counts_key, {'counts': counts}, cache_size)
+
+    return data, cn_profiles, counts
+
+
+def prepare(liquid_bam,
+            output,
+            cn_profiles_path,
+            clone_bams,
+            tissue_vcf,
+            counts_mat,
+            model,
+            gc,
+            mapp,
+            chrs,
+            bin_size,
+            qual,
+            verbose,
+            temp_dir,
+            read_counter,
+            correction,
+            use_cache,
+            clear_cache,
+            cache_size,
+            num_workers,
+            count_mode,
+            count_cache_dir,
+            profile,
+            profile_stages):
+    """
+    Preprocess the inputs of one liquid sample and write them to a .npz bundle (see bundle.save_bundle)
+    """
+    with profiled(profile, profile_stages.split(',')):
+        if clear_cache:
+            clear_caches(temp_dir, count_cache_dir, verbose)
+
+        data, cn_profiles, counts = preprocess(liquid_bam,
+                                               cn_profiles_path,
+                                               clone_bams,
+                                               tissue_vcf,
+                                               counts_mat,
+                                               model,
+                                               gc,
+                                               mapp,
+                                               chrs,
+                                               bin_size,
+                                               qual,
+                                               verbose,
+                                               temp_dir,
+                                               num_workers,
+                                               count_mode,
+                                               use_cache,
+                                               cache_size,
+                                               correction,
+                                               read_counter,
+                                               count_cache_dir)
+        _print('Writing preprocessed inputs to {}'.format(output), verbose)
+        with stage('save_bundle', bins=len(data)):
+            save_bundle(output, data, cn_profiles, counts)
 
 
 def run(liquid_bam,
@@ -21,39 +192,100 @@ def run(liquid_bam,
         bin_size,
         qual,
         verbose,
-        temp_dir):
+        temp_dir,
+        num_workers,
+        count_mode,
+        use_cache,
+        clear_cache,
+        cache_size,
+        count_cache_dir,
+        correction,
+        read_counter,
+        num_chains,
+        chain_method,
+        pad_buckets,
+        jit_cache_dir,
+        engine,
+        svi_steps,
+        learning_rate,
+        compress,
+        thin,
+        checkpoint_every,
+        min_ess,
+        max_rhat,
+        coarse_factor,
+        fine_warmup,
+        profile,
+        profile_stages):
 
-    # load data and preprocess
-    if get_extension(liquid_bam) == '.tsv':
-        raw_data, raw_cn_profiles = load_data(liquid_bam, cn_profiles_path)
-    elif get_extension(liquid_bam) == '.bam':
-        raw_data, raw_cn_profiles = preprocess_bam_file(liquid_bam, cn_profiles_path, chrs, bin_size, qual, gc, mapp, verbose, temp_dir)
+    with profiled(profile, profile_stages.split(',')):
+        if clear_cache:
+            clear_caches(temp_dir, count_cache_dir, verbose)
 
-    data, cn_profiles = remove_outliers(raw_data, raw_cn_profiles, verbose)
+        data, cn_profiles, counts = preprocess(liquid_bam,
+                                               cn_profiles_path,
+                                               clone_bams,
+                                               tissue_vcf,
+                                               counts_mat,
+                                               model,
+                                               gc,
+                                               mapp,
+                                               chrs,
+                                               bin_size,
+                                               qual,
+                                               verbose,
+                                               temp_dir,
+                                               num_workers,
+                                               count_mode,
+                                               use_cache,
+                                               cache_size,
+                                               correction,
+                                               read_counter,
+                                               count_cache_dir)
 
-    # get counts at SNV locations if applicable
-    if counts_mat is not None:
-        counts = load_counts(counts_mat)
-    elif clone_bams == ('',) and tissue_vcf == ('',) or model == 'cn':
-        counts = None
-    else:
-        counts_liquid = get_counts(liquid_bam, tissue_vcf, verbose)
-        counts_clones = []
-        for i in range(len(clone_bams)):
-            counts_clones.append(get_counts(clone_bams[i], tissue_vcf, verbose))
-        counts = process_counts(counts_liquid, counts_clones, cn_profiles, verbose)
-
-    cn_profiles = cn_profiles[:, 3:].squeeze()  # first three columns are genomic bin information which we don't need for inference
-    data = data.squeeze()
-
-    sampler_obj = run_inference(model,
-                                data,
-                                cn_profiles, 
-                                counts,
-                                num_samples,
-                                num_warmup,
-                                int(seed),
-                                progress_bar,
-                                verbose)
-
-    save_results(output, sampler_obj, cn_profiles.shape[1]-1, verbose)
+        # jax is imported before the stage starts so its compilation time is recorded
+        if engine == 'nuts':
+            from src.inference import run_inference
+        else:
+            from src.variational import run_variational
+
+        with stage('inference', engine=engine, bins=len(data), snvs=0 if counts is None else len(counts)):
+            if engine == 'nuts':
+                samples = run_inference(model,
+                                        data,
+                                        cn_profiles,
+                                        counts,
+                                        num_samples,
+                                        num_warmup,
+                                        int(seed),
+                                        progress_bar,
+                                        verbose,
+                                        num_chains,
+                                        chain_method,
+                                        pad_buckets,
+                                        jit_cache_dir,
+                                        compress,
+                                        thin,
+                                        checkpoint_every=checkpoint_every,
+                                        temp_dir=temp_dir if use_cache else None,
+                                        cache_size=cache_size,
+                                        min_ess=min_ess,
+                                        max_rhat=max_rhat,
+                                        coarse_factor=coarse_factor,
+                                        fine_warmup=fine_warmup)
+            else:
+                samples = run_variational(model,
+                                          data,
+                                          cn_profiles,
+                                          counts,
+                                          engine,
+                                          num_samples,
+                                          svi_steps,
+                                          learning_rate,
+                                          int(seed),
+                                          verbose,
+                                          compress,
+                                          thin)
+
+        with stage('save_results', draws=samples['tau'].size):
+            save_results(output, samples, cn_profiles.shape[1]-1, verbose)
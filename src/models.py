@@ -4,33 +4,105 @@ import numpy as np
 import jax.numpy as jnp
 from jax.random import PRNGKey
 
-def base(data, cn_profiles, num_clones):
+def masked_mean(x, mask):
+    if mask is None:
+        return jnp.mean(x)
+    return jnp.sum(x*mask) / jnp.sum(mask)
+
+def base(data, cn_profiles, num_clones, mask=None):
     """
     :param data: (n,) numpy array
     :param cn_profiles: (n, num_clones) numpy array
     :param num_clones: integer
+    :param mask: (n,) boolean numpy array or None - False for padding bins (padding rows of cn_profiles must be positive)
     """
     rho = numpyro.sample('rho', numdist.Dirichlet(jnp.ones(num_clones)))
-    mu = jnp.log(jnp.sum(cn_profiles*rho, axis=1)) - jnp.log(jnp.mean(jnp.sum(cn_profiles*rho, axis=1)))
+    mu = jnp.log(jnp.sum(cn_profiles*rho, axis=1)) - jnp.log(masked_mean(jnp.sum(cn_profiles*rho, axis=1), mask))
     tau = numpyro.sample('tau', numdist.InverseGamma(3, 1))
     with numpyro.plate('data', size=len(data)):
-        numpyro.sample('obs', numdist.StudentT(df=4, loc=mu, scale=tau), obs=data)
+        numpyro.sample('obs', numdist.StudentT(df=4, loc=mu, scale=tau).mask(True if mask is None else mask), obs=data)
 
-def extended(data, cn_profiles, counts, num_clones):
+def extended(data, cn_profiles, counts, num_clones, mask=None, snv_mask=None):
     """
     :param data: (n,) numpy array
     :param cn_profiles: (n, num_clones) numpy array
     :param counts: (L, 2+K) numpy array - L=length of intersection of SNV positions, 2+K=ref and alt counts for liquid biopsy and num clones (normal is not a clone)
     :param num_clones: integer
+    :param mask: (n,) boolean numpy array or None - False for padding bins (padding rows of cn_profiles must be positive)
+    :param snv_mask: (L,) boolean numpy array or None - False for padding SNVs
     """
     rho = numpyro.sample('rho', numdist.Dirichlet(jnp.ones(num_clones)))
-    mu = jnp.log(jnp.sum(cn_profiles*rho, axis=1)) - jnp.log(jnp.mean(jnp.sum(cn_profiles*rho, axis=1)))
+    mu = jnp.log(jnp.sum(cn_profiles*rho, axis=1)) - jnp.log(masked_mean(jnp.sum(cn_profiles*rho, axis=1), mask))
     tau = numpyro.sample('tau', numdist.InverseGamma(3, 1))
     with numpyro.plate('data', size=len(data)):
-        numpyro.sample('obs', numdist.StudentT(df=4, loc=mu, scale=tau), obs=data)
+        numpyro.sample('obs', numdist.StudentT(df=4, loc=mu, scale=tau).mask(True if mask is None else mask), obs=data)
 
     xi = jnp.sum(counts[:, 2:]*rho[:-1], axis=1)
     d = jnp.sum(counts[:, :2], axis=1)
     b = counts[:, 1]
     with numpyro.plate('snv', size=len(xi)):
-        numpyro.sample('snv_obs', numdist.BinomialLogits(xi, d), obs=b)
+        numpyro.sample('snv_obs', numdist.BinomialLogits(xi, d).mask(True if snv_mask is None else snv_mask), obs=b)
+
+def compressed_base(data, configs, config_idx, weights, num_clones, mask=None):
+    """
+    base model with the bins compressed to their unique copy-number configurations - mu and the normalising mean
+    are computed once per configuration and gathered per bin (gradients flow back as a segment sum over config_idx)
+    :param data: (n,) numpy array
+    :param configs: (C, num_clones) numpy array - unique rows of cn_profiles (padding rows must be positive)
+    :param config_idx: (n,) integer numpy array - row of configs for each bin
+    :param weights: (C,) numpy array - number of (unmasked) bins with each configuration
+    :param num_clones: integer
+    :param mask: (n,) boolean numpy array or None - False for padding bins
+    """
+    rho = numpyro.sample('rho', numdist.Dirichlet(jnp.ones(num_clones)))
+    total = jnp.sum(configs*rho, axis=1)
+    mu = jnp.log(total) - jnp.log(jnp.sum(total*weights) / jnp.sum(weights))
+    tau = numpyro.sample('tau', numdist.InverseGamma(3, 1))
+    with numpyro.plate('data', size=len(data)):
+        numpyro.sample('obs', numdist.StudentT(df=4, loc=mu[config_idx], scale=tau).mask(True if mask is None else mask), obs=data)
+
+def compressed_extended(data, configs, config_idx, weights, snv_coefs, snv_alt, snv_depth, num_clones, mask=None, snv_mask=None):
+    """
+    extended model with compressed bins (see compressed_base) and SNVs aggregated by their clone coefficients - SNVs
+    sharing a success probability contribute only through their summed alt counts and depths
+    :param snv_coefs: (G, K) numpy array - unique rows of counts[:, 2:]
+    :param snv_alt: (G,) numpy array - summed alt counts of the SNVs with each row of snv_coefs
+    :param snv_depth: (G,) numpy array - summed depths of the SNVs with each row of snv_coefs
+    :param snv_mask: (G,) boolean numpy array or None - False for padding rows
+    """
+    rho = numpyro.sample('rho', numdist.Dirichlet(jnp.ones(num_clones)))
+    total = jnp.sum(configs*rho, axis=1)
+    mu = jnp.log(total) - jnp.log(jnp.sum(total*weights) / jnp.sum(weights))
+    tau = numpyro.sample('tau', numdist.InverseGamma(3, 1))
+    with numpyro.plate('data', size=len(data)):
+        numpyro.sample('obs', numdist.StudentT(df=4, loc=mu[config_idx], scale=tau).mask(True if mask is None else mask), obs=data)
+
+    xi = jnp.sum(snv_coefs*rho[:-1], axis=1)
+    with numpyro.plate('snv', size=len(xi)):
+        numpyro.sample('snv_obs', numdist.BinomialLogits(xi, snv_depth).mask(True if snv_mask is None else snv_mask), obs=snv_alt)
+
+def stacked(data, cn_profiles, mask, counts, snv_mask):
+    """
+    base (counts=None) or extended model for several independent liquid samples fitted at once. Samples are
+    padded to a common number of bins/SNVs and the padding is masked out of the likelihood
+    :param data: (S, n) numpy array
+    :param cn_profiles: (S, n, num_clones) numpy array - padding rows must be positive (ex. ones)
+    :param mask: (S, n) boolean numpy array - False for padding bins
+    :param counts: (S, L, 2+K) numpy array or None
+    :param snv_mask: (S, L) boolean numpy array or None - False for padding SNVs
+    """
+    num_clones = cn_profiles.shape[-1]  # taken from the shape so it stays static when model arguments are traced
+    with numpyro.plate('samples', data.shape[0], dim=-2):
+        rho = numpyro.sample('rho', numdist.Dirichlet(jnp.ones(num_clones)))  # (S, 1, num_clones)
+        tau = numpyro.sample('tau', numdist.InverseGamma(3, 1))  # (S, 1)
+        total = jnp.sum(cn_profiles*rho, axis=-1)
+        mu = jnp.log(total) - jnp.log(jnp.sum(total*mask, axis=-1, keepdims=True) / jnp.sum(mask, axis=-1, keepdims=True))
+        with numpyro.plate('data', size=data.shape[1], dim=-1):
+            numpyro.sample('obs', numdist.StudentT(df=4, loc=mu, scale=tau).mask(mask), obs=data)
+
+        if counts is not None:
+            xi = jnp.sum(counts[..., 2:]*rho[..., :-1], axis=-1)
+            d = jnp.sum(counts[..., :2], axis=-1)
+            b = counts[..., 1]
+            with numpyro.plate('snv', size=counts.shape[1], dim=-1):
+                numpyro.sample('snv_obs', numdist.BinomialLogits(xi, d).mask(snv_mask), obs=b)
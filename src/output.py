@@ -0,0 +1,120 @@
+import os
+import string
+import numpy as np
+import pandas as pd
+
+from src.utils import get_extension, _print
+
+CHUNK_SIZE = 100000  # number of draws converted and written at a time
+HDI_PROB = 0.95
+
+
+def get_clones(num_subclones):
+    return list(string.ascii_uppercase)[:num_subclones] + ['normal']
+
+def get_summary_path(path):
+    return os.path.splitext(path)[0] + '.summary.csv'
+
+def iter_draw_chunks(samples, clones, chunk_size=CHUNK_SIZE):
+    """
+    Flatten posterior draws to columns and yield them chunk_size rows at a time (at least one, possibly empty, chunk)
+    Arguments:
+        samples: dictionary with sites rho and tau - each of shape (num_chains, num_draws, ...)
+        clones: list of strings - column names of the entries of rho
+        chunk_size: an integer
+    Returns:
+        Generator of dictionaries mapping column names [chain, tau, clones...] to (<= chunk_size,) ndarrays
+    """
+    rho = np.asarray(samples['rho'])
+    num_chains, num_draws = rho.shape[:2]
+    rho = rho.reshape(num_chains * num_draws, -1)
+    sites = {name: np.asarray(site).reshape(num_chains * num_draws) for name, site in samples.items() if name != 'rho'}
+    chains = np.repeat(np.arange(num_chains), num_draws)
+
+    for start in range(0, max(len(rho), 1), chunk_size):
+        rows = slice(start, start + chunk_size)
+        chunk = {'chain': chains[rows]}
+        chunk.update({name: site[rows] for name, site in sites.items()})
+        chunk.update({clone: rho[rows, i] for i, clone in enumerate(clones)})
+        yield chunk
+
+def write_draws(path, samples, clones, chunk_size=CHUNK_SIZE):
+    """
+    Write posterior draws with one row per draw, chunk by chunk. The format follows the extension of path
+    (one of {.csv, .parquet, .feather, .npz}, anything else is written as csv) - parquet and feather need pyarrow
+    Arguments:
+        path: a string
+        samples: dictionary with sites rho and tau - each of shape (num_chains, num_draws, ...)
+        clones: list of strings
+        chunk_size: an integer
+    """
+    extension = get_extension(path)
+    chunks = iter_draw_chunks(samples, clones, chunk_size)
+
+    if extension == '.npz':
+        # columns are views of the draws, so a single chunk holding everything costs no copy
+        np.savez(path, **next(iter_draw_chunks(samples, clones, np.iinfo(np.int64).max)))
+    elif extension in ['.parquet', '.feather']:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError(f"Writing {extension} files requires pyarrow (pip install pyarrow)")
+        writer = None
+        for chunk in chunks:
+            batch = pa.RecordBatch.from_pydict(chunk)
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema) if extension == '.parquet' else pa.ipc.new_file(path, batch.schema)
+            writer.write_batch(batch)
+        writer.close()
+    else:
+        with open(path, 'w') as f:
+            for i, chunk in enumerate(chunks):
+                pd.DataFrame(chunk).to_csv(f, header=i == 0, index=False)
+
+def summarize(samples, clones, hdi_prob=HDI_PROB):
+    """
+    Summarise the posterior of each clone prevalence, the tumour fraction (1 - normal prevalence) and tau
+    Arguments:
+        samples: dictionary with sites rho and tau - each of shape (num_chains, num_draws, ...)
+        clones: list of strings
+        hdi_prob: a float - probability mass of the highest density interval
+    Returns:
+        Pandas dataframe with one row per parameter and columns [parameter, mean, sd, median, hdi_low, hdi_high, ess_bulk, ess_tail, r_hat]
+    """
+    from numpyro.diagnostics import hpdi  # pulls in jax
+    from src.diagnostics import diagnose
+
+    rho = np.asarray(samples['rho'])
+    parameters = {clone: rho[..., i] for i, clone in enumerate(clones)}
+    parameters['tumour_fraction'] = 1 - rho[..., -1]
+    parameters['tau'] = np.asarray(samples['tau'])
+
+    rows = []
+    for name, draws in parameters.items():
+        draws = draws.astype(float)  # one parameter at a time keeps the float64 copy small
+        hdi_low, hdi_high = hpdi(draws.reshape(-1), prob=hdi_prob)
+        # split chain diagnostics need at least two draws per half chain
+        diagnostics = diagnose(draws) if draws.shape[1] >= 4 else {'ess_bulk': np.nan, 'ess_tail': np.nan, 'r_hat': np.nan}
+        rows.append({'parameter': name,
+                     'mean': draws.mean(),
+                     'sd': draws.std(),
+                     'median': np.median(draws),
+                     'hdi_low': hdi_low,
+                     'hdi_high': hdi_high,
+                     **diagnostics})
+    return pd.DataFrame(rows)
+
+def save_results(path, samples, num_subclones, verbose):
+    """
+    Write posterior draws to path (see write_draws) and their summary next to it (see get_summary_path)
+    Arguments:
+        path: a string
+        samples: dictionary with sites rho and tau - each of shape (num_chains, num_draws, ...)
+        num_subclones: an integer
+        verbose: a boolean
+    """
+    _print('Saving results', verbose)
+    clones = get_clones(num_subclones)
+    write_draws(path, samples, clones)
+    summarize(samples, clones).to_csv(get_summary_path(path), index=False)
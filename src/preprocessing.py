@@ -2,21 +2,17 @@ import os
 import subprocess
 import numpy as np
 import pandas as pd
-import pysam
-from collections import defaultdict
-from sklearn.mixture import GaussianMixture
-import pyranges as pr
-
-from rpy2 import robjects
-from rpy2.robjects.packages import importr
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
-# only display errors, suppress warning messages
-from rpy2.rinterface_lib.callbacks import logger
 import logging
-logger.setLevel(logging.ERROR)
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
-from src.utils import get_random_string, _print
+from src.utils import get_random_string, group_rows, read_cn_profiles, _print
+from src.cache import make_key, file_identity, load_cached, store_cached
+from src.correction import wigs_to_ranged_data, correct_readcount, write_wig
+from src.profiling import stage
+
+READ_FLAG_FILTER = 0x404  # unmapped, duplicate
+MAX_LISTED_CONTIGS = 30  # contigs of the bam file listed when none of the requested chromosomes match
 
 
 def get_reads(bam_file_path, chrs, bin_size, qual, verbose, temp_dir):
@@ -32,6 +28,8 @@ def get_reads(bam_file_path, chrs, bin_size, qual, verbose, temp_dir):
     Returns:
         Path to file containing binned read counts
     """
+    import pysam  # pysam (like rpy2 below) is only imported by the code paths that read bam files
+
     if not os.path.exists(bam_file_path + '.bai'):
         _print('Indexing {}'.format(bam_file_path), verbose)
         pysam.index(bam_file_path)
@@ -42,16 +40,109 @@ def get_reads(bam_file_path, chrs, bin_size, qual, verbose, temp_dir):
     subprocess.run(command, shell=True, check=True)
     return readcount_path
 
-def correct_reads(readcount_path, gc_path, map_path):
+def _count_contig_reads(job):
+    import pysam
+    bam_file_path, contig, length, bin_size, qual = job
+    bam = pysam.AlignmentFile(bam_file_path)
+    starts = np.fromiter((read.reference_start for read in bam.fetch(contig)
+                          if not (read.flag & READ_FLAG_FILTER) and read.mapping_quality >= qual), dtype=np.int64)
+    bam.close()
+    return np.bincount(starts // bin_size, minlength=-(-length // bin_size))
+
+def match_contigs(chrs, references):
+    """
+    Match requested chromosomes to the contigs of a bam file - a chromosome that is not a contig is matched to the
+    contig named with or without the 'chr' prefix (so 1 matches chr1 and chr1 matches 1)
+    Arguments:
+        chrs: a string - comma separated chromosomes
+        references: list of contig names
+    Returns:
+        List of matched contig names and list of the chromosomes without a contig
+    """
+    references = set(references)
+    contigs, missing = [], []
+    for chromosome in chrs.split(','):
+        alternative = chromosome[len('chr'):] if chromosome.startswith('chr') else 'chr' + chromosome
+        if chromosome in references:
+            contigs.append(chromosome)
+        elif alternative in references:
+            contigs.append(alternative)
+        else:
+            missing.append(chromosome)
+    return contigs, missing
+
+def count_reads(bam_file_path, chrs, bin_size, qual, num_workers, verbose):
+    """
+    Count reads starting in fixed size bins without the readCounter binary (reads that are unmapped, duplicates
+    or have a mapping quality below qual are ignored). Contigs are counted in parallel
+    Arguments:
+        bam_file_path: a string
+        chrs: a string
+        bin_size: a string
+        qual: a string
+        num_workers: an integer
+        verbose: a boolean
+    Returns:
+        Pandas dataframe with columns [chr, start, end, reads] - start and end are 1-based and inclusive like in readCounter's wig
+    """
+    import pysam
+    _print('Counting reads in {} bp bins'.format(bin_size), verbose)
+    bin_size, qual = int(bin_size), int(qual)
+
+    with pysam.AlignmentFile(bam_file_path) as bam:
+        lengths = dict(zip(bam.references, bam.lengths))
+        mapped = {stat.contig: stat.mapped for stat in bam.get_index_statistics()}
+    contigs, missing = match_contigs(chrs, lengths)
+    if len(contigs) == 0:
+        available = list(lengths)[:MAX_LISTED_CONTIGS] + (['...'] if len(lengths) > MAX_LISTED_CONTIGS else [])
+        raise RuntimeError(f"None of the chromosomes {chrs} are contigs of {bam_file_path} (contigs: {', '.join(available)})")
+    if len(missing) > 0:
+        warnings.warn(f"Chromosomes {', '.join(missing)} are not contigs of {bam_file_path} and are skipped")
+
+    # contigs without mapped reads (from the index statistics) don't need to be read
+    jobs = [(bam_file_path, contig, lengths[contig], bin_size, qual) for contig in contigs if mapped.get(contig, 0) > 0]
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            counted = dict(zip([job[1] for job in jobs], executor.map(_count_contig_reads, jobs)))
+    else:
+        counted = {job[1]: _count_contig_reads(job) for job in jobs}
+
+    chr_col, start_col, reads_col = [], [], []
+    for contig in contigs:
+        reads = counted.get(contig, np.zeros(-(-lengths[contig] // bin_size), dtype=np.int64))
+        chr_col.append(np.full(len(reads), contig, dtype=object))
+        start_col.append(np.arange(len(reads), dtype=np.int64) * bin_size + 1)
+        reads_col.append(reads)
+
+    starts = np.concatenate(start_col)
+    return pd.DataFrame({'chr': np.concatenate(chr_col), 'start': starts, 'end': starts + bin_size - 1, 'reads': np.concatenate(reads_col)})
+
+def correct_reads(readcount_path, gc_path, map_path, correction='hmmcopy'):
     """
-    Use HMMcopy package to perform gc and mappability correction
+    Perform gc and mappability correction with the HMMcopy package or the native implementation in src.correction
     Arguments:
-        readcount_path: a string
+        readcount_path: a string (or a pandas dataframe from count_reads when correction is native)
         gc_path: a string
         map_path: a string
+        correction: a string (one of {hmmcopy, native})
     Returns:
         Pandas dataframe with the corrected read counts
     """
+    if correction == 'native':
+        data = correct_readcount(wigs_to_ranged_data(readcount_path, gc_path, map_path))
+        return data[['chr', 'start', 'end', 'copy']]
+    elif correction != 'hmmcopy':
+        raise RuntimeError(f"Unknown correction {correction} (must be one of hmmcopy, native)")
+
+    # R is only started when HMMcopy is requested
+    from rpy2 import robjects
+    from rpy2.robjects.packages import importr
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.conversion import localconverter
+    # only display errors, suppress warning messages
+    from rpy2.rinterface_lib.callbacks import logger
+    logger.setLevel(logging.ERROR)
+
     hmmcopy = importr('HMMcopy')
     data = hmmcopy.wigsToRangedData(readcount_path, 
                                     gc_path,
@@ -63,93 +154,186 @@ def correct_reads(readcount_path, gc_path, map_path):
     return corrected_readcounts
 
 def intersect(corrected_readcounts, cn_profiles_path):
-    cn_profiles = pd.read_csv(cn_profiles_path, sep='\t', header=None)
+    """
+    Join corrected readcount bins to the copy-number bins containing their midpoints. Bins may have different sizes -
+    the copy values of all readcount bins within a copy-number bin are averaged (nan values ignored). Copy-number
+    bins without a readcount bin, or with missing coordinates or copy numbers, are dropped
+    Arguments:
+        corrected_readcounts: pandas dataframe with columns [chr, start, end, copy]
+        cn_profiles_path: a string
+    Returns:
+        Three ndarrays - (n,) float32 mean copy of each copy-number bin, (n, 3) int32 bins and (n, num_clones) copy
+        numbers (sorted by position, see utils.read_cn_profiles)
+    """
+    bins, cn_profiles = read_cn_profiles(cn_profiles_path)
+    order = np.lexsort((bins[:, 1], bins[:, 0]))
+    bins, cn_profiles = bins[order], cn_profiles[order]
 
-    # format column names for PyRanges
-    corrected_readcounts.rename(columns={'chr': 'Chromosome', 'start': 'Start', 'end': 'End'}, inplace=True)
-    cn_profiles.columns = [str(num) for num in range(cn_profiles.shape[1])]
-    cn_profiles = cn_profiles.rename(columns={'0': 'Chromosome', '1': 'Start', '2': 'End'}).astype({'Chromosome': int, 'Start': int, 'End': int})
+    # readcount chromosomes can be named chr1 or 1, copy-number profiles use numbers
+    readcount_chrs = pd.to_numeric(corrected_readcounts['chr'].astype(str).str.replace('^chr', '', regex=True), errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+    midpoints = (corrected_readcounts['start'].to_numpy(dtype=np.int64) + corrected_readcounts['end'].to_numpy(dtype=np.int64)) // 2
+    copy = corrected_readcounts['copy'].to_numpy(dtype=float)
 
-    # intersect both ways
-    corrected_readcounts_gr, cn_profiles_gr = pr.PyRanges(corrected_readcounts).sort(), pr.PyRanges(cn_profiles).sort()
-    gr1 = corrected_readcounts_gr.intersect(cn_profiles_gr)
-    gr2 = cn_profiles_gr.intersect(corrected_readcounts_gr)
+    # one searchsorted over (chromosome, position) keys finds the last copy-number bin starting before each midpoint
+    cn_keys = (bins[:, 0].astype(np.int64) << 32) | bins[:, 1]
+    positions = np.searchsorted(cn_keys, (readcount_chrs << 32) | midpoints, side='right') - 1
+    clipped = np.maximum(positions, 0)
+    inside = (positions >= 0) & (readcount_chrs >= 0) & (bins[clipped, 0] == readcount_chrs) & (midpoints <= bins[clipped, 2]) & ~np.isnan(copy)
 
-    corrected_readcounts_intersected = pd.concat([gr1.df.astype({'Chromosome': int}), gr2.df.astype({'Chromosome': int})], axis=1).dropna()
-    return corrected_readcounts_intersected[['copy']].to_numpy().squeeze(), corrected_readcounts_intersected.iloc[:, 4:].to_numpy().squeeze()
+    totals = np.bincount(positions[inside], weights=copy[inside], minlength=len(bins))
+    numbers = np.bincount(positions[inside], minlength=len(bins))
+    keep = (numbers > 0) & (bins[:, 0] >= 0)
+    if cn_profiles.dtype.kind == 'f':
+        keep &= ~np.isnan(cn_profiles).any(axis=1)
+    return (totals[keep] / numbers[keep]).astype(np.float32), bins[keep], cn_profiles[keep]
 
-def preprocess_bam_file(bam_file_path, cn_profiles_path, chrs, bin_size, qual, gc, mapp, verbose, temp_dir):
+def preprocess_bam_file(bam_file_path, cn_profiles_path, chrs, bin_size, qual, gc, mapp, verbose, temp_dir, use_cache, cache_size, correction, read_counter, num_workers):
+    import pysam
     _print('Processing .bam file', verbose)
-    _print('Getting readcounts', verbose)
 
     if gc is None or mapp is None:
         raise RuntimeError("Must specify GC and Mappability files!")
+    if read_counter not in ['readcounter', 'native']:
+        raise RuntimeError(f"Unknown read counter {read_counter} (must be one of readcounter, native)")
 
-    readcount_path = get_reads(bam_file_path, chrs, bin_size, qual, verbose, temp_dir)
+    if not os.path.exists(bam_file_path + '.bai'):
+        _print('Indexing {}'.format(bam_file_path), verbose)
+        pysam.index(bam_file_path)
 
-    _print('Correcting readcounts', verbose)
-    corrected_readcounts = correct_reads(readcount_path, gc, mapp)
+    key = make_key(file_identity(bam_file_path), chrs, bin_size, qual, os.path.abspath(gc), os.path.abspath(mapp), correction, read_counter)
+    cached = load_cached(temp_dir, 'readcounts', key) if use_cache else None
 
-    _print('Intersecting readcounts with CN profiles', verbose)
-    data, cn_profiles = intersect(corrected_readcounts, cn_profiles_path)
+    if cached is not None:
+        _print('Loading corrected readcounts from cache', verbose)
+        corrected_readcounts = pd.DataFrame(cached)
+    else:
+        _print('Getting readcounts', verbose)
+        readcount_path = None
+        with stage('read_counts', read_counter=read_counter):
+            if read_counter == 'native':
+                readcounts = count_reads(bam_file_path, chrs, bin_size, qual, num_workers, verbose)
+                if correction == 'hmmcopy':
+                    # HMMcopy reads its input from a wig file
+                    readcount_path = os.path.join(temp_dir, f'readcounts{get_random_string()}.wig')
+                    os.makedirs(temp_dir, exist_ok=True)
+                    write_wig(readcounts.rename(columns={'reads': 'value'}), readcount_path)
+                    readcounts = readcount_path
+            else:
+                readcount_path = readcounts = get_reads(bam_file_path, chrs, bin_size, qual, verbose, temp_dir)
+
+        _print(f'Correcting readcounts ({correction})', verbose)
+        with stage('correct_reads', correction=correction) as info:
+            corrected_readcounts = correct_reads(readcounts, gc, mapp, correction)
+            info['bins'] = len(corrected_readcounts)
 
-    # remove unnecessary file
-    os.remove(readcount_path)
+        # remove unnecessary file
+        if readcount_path is not None:
+            os.remove(readcount_path)
 
-    return data, cn_profiles
+        if use_cache:
+            store_cached(temp_dir, 'readcounts', key, {
+                'chr': corrected_readcounts['chr'].astype(str).to_numpy(dtype=str),
+                'start': corrected_readcounts['start'].to_numpy(dtype=np.int64),
+                'end': corrected_readcounts['end'].to_numpy(dtype=np.int64),
+                'copy': corrected_readcounts['copy'].to_numpy(dtype=np.float64)
+            }, cache_size)
+
+    _print('Intersecting readcounts with CN profiles', verbose)
+    with stage('intersect', readcount_bins=len(corrected_readcounts), cached=cached is not None) as info:
+        data, bins, cn_profiles = intersect(corrected_readcounts, cn_profiles_path)
+        info['bins'] = len(data)
+
+    return data, bins, cn_profiles
     
-def remove_outliers(data, cn_profiles, verbose):
+def fit_gmms(values, groups, num_groups, max_iter=100, tol=1e-3, reg_covar=1e-6):
+    """
+    Fit an independent two component 1D gaussian mixture to the values of every group at once with a batched EM
+    (same updates and per-group stopping rule as sklearn's GaussianMixture). Components are initialised
+    deterministically by 2-means started from a split at the group mean, so the fit is reproducible between runs
+    Arguments:
+        values: (n,) ndarray
+        groups: (n,) int ndarray - group index of each value in [0, num_groups)
+        num_groups: an integer
+    Returns:
+        Two ndarrays - (n,) component assignment of each value and (num_groups, 2) component variances
+    """
+    sizes = np.bincount(groups, minlength=num_groups).astype(float)
+
+    def group_sum(g, weights):
+        return np.bincount(g, weights=weights, minlength=num_groups)
+
+    def m_step(x, g, resp):
+        nk = np.stack([group_sum(g, resp[:, k]) for k in range(2)], axis=1) + 10 * np.finfo(float).eps
+        means = np.stack([group_sum(g, resp[:, k] * x) for k in range(2)], axis=1) / nk
+        variances = np.stack([group_sum(g, resp[:, k] * (x - means[g, k]) ** 2) for k in range(2)], axis=1) / nk + reg_covar
+        return nk / np.maximum(sizes, 1)[:, None], means, variances
+
+    def weighted_log_prob(x, g, weights, means, variances):
+        # per-group constants are computed once and gathered, not per value
+        log_norm_const = np.log(weights) - 0.5 * np.log(2 * np.pi * variances)
+        return log_norm_const[g] - (x[:, None] - means[g]) ** 2 * (0.5 / variances)[g]
+
+    # 2-means initialisation
+    centers = group_sum(groups, values) / np.maximum(sizes, 1)
+    labels = (values > centers[groups]).astype(int)
+    for _ in range(10):
+        resp = np.stack([labels == 0, labels == 1], axis=1).astype(float)
+        counts = np.stack([group_sum(groups, resp[:, k]) for k in range(2)], axis=1)
+        centers = np.stack([group_sum(groups, resp[:, k] * values) for k in range(2)], axis=1) / np.maximum(counts, 1)
+        new_labels = np.argmin(np.abs(values[:, None] - centers[groups]), axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    resp = np.stack([labels == 0, labels == 1], axis=1).astype(float)
+
+    # EM - groups drop out of the batch once their lower bound has converged
+    weights, means, variances = m_step(values, groups, resp)
+    lower_bound = np.full(num_groups, -np.inf)
+    active = sizes > 0
+    for _ in range(max_iter):
+        points = active[groups]
+        x, g = values[points], groups[points]
+        log_prob = weighted_log_prob(x, g, weights, means, variances)
+        log_norm = np.logaddexp(log_prob[:, 0], log_prob[:, 1])
+        new_weights, new_means, new_variances = m_step(x, g, np.exp(log_prob - log_norm[:, None]))
+        weights[active], means[active], variances[active] = new_weights[active], new_means[active], new_variances[active]
+
+        new_lower_bound = group_sum(g, log_norm) / np.maximum(sizes, 1)
+        converged = active & (np.abs(new_lower_bound - lower_bound) < tol)
+        lower_bound[active] = new_lower_bound[active]
+        active &= ~converged
+        if not np.any(active):
+            break
+
+    return np.argmax(weighted_log_prob(values, groups, weights, means, variances), axis=1), variances
+
+def remove_outliers(data, bins, cn_profiles, verbose):
     """
     Remove outliers based on CN configuration - ex. (2,2,2), (2,3,2)
     Arguments:
-        data: ndarray
-        cn_profiles: ndarray
+        data: (n,) ndarray
+        bins: (n, 3) ndarray
+        cn_profiles: (n, num_clones) ndarray
         verbose: bool
     Returns:
-        Two ndarrays corresponding to original arguments data, cn_profiles with outliers filtered out
+        Three ndarrays corresponding to original arguments data, bins, cn_profiles with outliers (and nan data) filtered out
     """
 
     _print('Identifying and removing outliers based on copy number configurations', verbose)
 
-    def remove_outliers_in_cn_config(cn_config, data, cn_profiles, indices, vals):
-        """
-        For a specific CN configuration, remove outliers by fitting a two component GMM
-        Arguments:
-            cn_config: tuple
-            data: ndarray
-            cn_profiles: ndarray
-        """
-            
-        # fit gmm
-        X = np.array(vals[cn_config]).reshape(-1, 1)
-        gmm = GaussianMixture(n_components=2).fit(X)  # fit gmm
-        labels = gmm.predict(X)  # get assignments for each observation
-        
-        if gmm.covariances_[0].squeeze() < gmm.covariances_[1].squeeze():
-            labels = np.invert(labels.astype(bool))
-        
-        # remove outliers from data.obs
-        outlier_idxs = np.array(indices[cn_config]).reshape(-1,1)[labels == 0]
-        
-        # set the outliers to nan
-        data[outlier_idxs] = np.nan
-        cn_profiles[outlier_idxs] = np.nan
-
-    # create dictionaries storing info for each CN configuration
-    indices = defaultdict(list)
-    vals = defaultdict(list)
-    for n in range(len(data)):
-        indices[tuple(cn_profiles[n, 3:])].append(n)  # don't need first 3 columns containing genomic position information
-        vals[tuple(cn_profiles[n, 3:])].append(data[n])
-        
-    # remove outliers from each CN configuration
-    for cn_config in list(vals.keys()):
-        if len(vals[cn_config]) < 50:
-            continue
-        remove_outliers_in_cn_config(cn_config, data, cn_profiles, indices, vals)
-
-    nan_idxs = ~np.isnan(data)
-    data = data[nan_idxs]
-    cn_profiles = cn_profiles[nan_idxs, :]
-
-    return data, cn_profiles
+    # group bins by CN configuration (nan data is dropped and left out of the fits)
+    _, config_idxs = group_rows(cn_profiles)
+    valid = ~np.isnan(data)
+
+    # only configurations with at least 50 bins are filtered, each with its own two component GMM
+    config_sizes = np.bincount(config_idxs[valid], minlength=config_idxs.max(initial=-1) + 1)
+    fitted = valid & (config_sizes[config_idxs] >= 50)
+    _, groups = np.unique(config_idxs[fitted], return_inverse=True)
+    labels, variances = fit_gmms(np.asarray(data[fitted], dtype=float), groups.reshape(-1), int(np.sum(config_sizes >= 50)))
+
+    # the component with the larger variance holds the outliers
+    outlier_component = (variances[:, 0] < variances[:, 1]).astype(int)
+    keep = valid
+    keep[np.flatnonzero(fitted)[labels == outlier_component[groups.reshape(-1)]]] = False
+
+    return data[keep], bins[keep], cn_profiles[keep]
@@ -1,36 +1,35 @@
 import os
 import string
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 import numpy as np
 import pandas as pd
 pd.options.mode.chained_assignment = None
 import pysam
-from pyrsistent import m
 
-from src.utils import _print
-
-def get_counts(bam_path, vcf_path, verbose):
+from src.cache import make_key, file_identity, load_cached, store_cached
+from src.utils import get_random_string, _print
+
+REGION_CHUNK_SIZE = 10000000  # genomic chunk (bp) handled by a single counting job
+COUNTS_COLUMNS = ['chr', 'pos', 'ref_counts', 'alt_counts']
+BASES = 'ACGT'  # ref and alt bases of the site table are indices into BASES
+SITES_VERSION = 2  # bump when the site table changes, so sidecar files are rewritten (2: indels and MNPs dropped)
+PILEUP_MAX_GAP = 1000  # sites closer than this (bp) are counted by the same pileup sweep
+PILEUP_MAX_DEPTH = 1000000
+PILEUP_FLAG_FILTER = 0xF04  # unmapped, secondary, qcfail, duplicate, supplementary
+MIN_MAPPING_QUALITY = 60
+MIN_BASE_QUALITY = 20
+COUNTS_CACHE_VERSION = 3  # bump when counting changes, so cached counts are not reused (3: indels and MNPs dropped)
+
+def get_sites(bcf):
     """
-    Get reference and alternate allele counts from bam file at SNV positions in vcf file
+    Iterate over the SNV sites of an open vcf file that pass filtering (PASS, bi-allelic, numeric contig, single base)
     Arguments:
-        bam_path: a string
-        vcf_path: a string
+        bcf: a pysam.VariantFile
     Returns:
-        A pandas dataframe with columns [event_id, ref, alt] - event_id=genomic location, ref=reference allele counts, alt=alternate allele counts
+        Generator of (contig, start, stop, ref, alt) tuples
     """
-
-    def check_read(read):
-        if read.is_duplicate or read.is_secondary or read.is_qcfail or read.is_supplementary or read.is_unmapped or (read.mapping_quality < 60):
-            return False
-        else:
-            return True
-
-    _print(f"Getting counts from {bam_path} at SNV positions in {vcf_path}", verbose)
-
-    bam = pysam.AlignmentFile(bam_path)
-    bcf = pysam.VariantFile(vcf_path)
-    df = []
-
     for row in bcf:
         filters = list(row.filter.keys())
 
@@ -40,129 +39,302 @@ def get_counts(bam_path, vcf_path, verbose):
         if len(row.alts) > 1:
              continue
 
-        if row.contig[0].isalpha():
-            continue
+        if not row.contig.isdigit():
+            continue  # positions are joined to the numeric chromosomes of the CN profiles
 
         ref = row.ref
 
         alt = row.alts[0]
 
-        if (len(ref) > 1) or (len(alt) > 1):
+        if (len(ref) != 1) or (len(alt) != 1):
+             continue  # indels and MNPs
+
+        if (ref not in BASES) or (alt not in BASES):
              continue
 
-        counts = dict(
-            zip("ACGT", bam.count_coverage(row.contig, row.start, row.stop, quality_threshold=20, read_callback=check_read))
-        )
+        yield row.contig, row.start, row.stop, ref, alt
+
+def parse_sites(vcf_path):
+    """
+    Parse the SNV sites of a vcf file that pass filtering (see get_sites) into a site table
+    Arguments:
+        vcf_path: a string
+    Returns:
+        Dictionary of ndarrays (site table) - contigs (contig names), contig_id (index into contigs), pos (1-based
+        position), ref and alt (index into BASES), one entry per site in vcf order
+    """
+    contigs, contig_ids, positions, refs, alts = {}, [], [], [], []
+    with pysam.VariantFile(vcf_path) as bcf:
+        for contig, start, stop, ref, alt in get_sites(bcf):
+            contig_ids.append(contigs.setdefault(contig, len(contigs)))
+            positions.append(stop)
+            refs.append(BASES.index(ref))
+            alts.append(BASES.index(alt))
+    return {'contigs': np.array(list(contigs), dtype=str),
+            'contig_id': np.array(contig_ids, dtype=np.int32),
+            'pos': np.array(positions, dtype=np.int64),
+            'ref': np.array(refs, dtype=np.int8),
+            'alt': np.array(alts, dtype=np.int8)}
+
+def get_sites_path(vcf_path):
+    return vcf_path + '.sites.npz'
+
+def load_sites(vcf_path, verbose):
+    """
+    Load the site table of a vcf file from its sidecar file (<vcf>.sites.npz), parsing the vcf and writing the
+    sidecar if it is missing or was written for a different version of the vcf (the sidecar is skipped if the
+    directory of the vcf is not writable)
+    Arguments:
+        vcf_path: a string
+        verbose: a boolean
+    Returns:
+        Dictionary of ndarrays - see parse_sites
+    """
+    path = get_sites_path(vcf_path)
+    key = make_key(file_identity(vcf_path), SITES_VERSION)
+    if os.path.exists(path):
+        with np.load(path) as f:
+            if str(f['key']) == key:
+                return {name: f[name] for name in f.files if name != 'key'}
+
+    _print(f"Parsing SNV sites in {vcf_path}", verbose)
+    sites = parse_sites(vcf_path)
+    # write to a unique file first so concurrent runs never read a partial sidecar
+    temp_path = f'{path}{get_random_string()}.npz'
+    try:
+        np.savez(temp_path, key=key, **sites)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return sites
+
+def split_sites(sites, chunk_size=REGION_CHUNK_SIZE):
+    """
+    Split a site table into the sites of genomic chunks of chunk_size bp
+    Arguments:
+        sites: dictionary of ndarrays - see parse_sites
+        chunk_size: an integer
+    Returns:
+        List of site tables
+    """
+    chunks = (sites['contig_id'].astype(np.int64) << 32) | (sites['pos'] // chunk_size)
+    bounds = np.r_[0, np.flatnonzero(chunks[1:] != chunks[:-1]) + 1, len(chunks)]
+    return [{name: array if name == 'contigs' else array[start:stop] for name, array in sites.items()}
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def get_counts(bam_path, sites, verbose, count_mode='coverage'):
+    """
+    Get reference and alternate allele counts from bam file at the SNV sites of a site table
+    Arguments:
+        bam_path: a string
+        sites: dictionary of ndarrays - see parse_sites
+        count_mode: a string (one of {coverage, pileup}) - see count_sites_coverage and count_sites_pileup
+    Returns:
+        A pandas dataframe with columns [chr, pos, ref_counts, alt_counts] - chr and pos=genomic location, ref_counts=reference allele counts, alt_counts=alternate allele counts
+    """
+    _print(f"Getting counts from {bam_path} at {len(sites['pos'])} SNV sites", verbose)
 
-        out_row = {
-            "event_id": ":".join([row.contig, str(row.stop)]),
-            "ref_counts": counts[ref][0],
-            "alt_counts": counts[alt][0]
-        }
+    if count_mode == 'coverage':
+        count_sites = count_sites_coverage
+    elif count_mode == 'pileup':
+        count_sites = count_sites_pileup
+    else:
+        raise RuntimeError(f"Unknown count mode {count_mode} (must be one of coverage, pileup)")
 
-        df.append(out_row)
+    contigs = sites['contigs'][sites['contig_id']]
+    site_list = [(contig, int(pos) - 1, int(pos), BASES[ref], BASES[alt]) for contig, pos, ref, alt in zip(contigs.tolist(), sites['pos'], sites['ref'], sites['alt'])]
+    bam = pysam.AlignmentFile(bam_path)
+    counts = count_sites(bam, site_list)
+    bam.close()
 
-    return pd.DataFrame(df)
+    return pd.DataFrame({'chr': contigs.astype(np.int64),
+                         'pos': sites['pos'],
+                         'ref_counts': np.array([site_counts[ref] for (_, _, _, ref, _), site_counts in zip(site_list, counts)], dtype=np.int64),
+                         'alt_counts': np.array([site_counts[alt] for (_, _, _, _, alt), site_counts in zip(site_list, counts)], dtype=np.int64)},
+                        columns=COUNTS_COLUMNS)
 
-def process_counts(_counts_liquid, _counts_clones, _cn_profiles, verbose):
+def count_sites_coverage(bam, sites):
+    """
+    Count bases at each site with one count_coverage call (index seek + python read filter) per site
+    Arguments:
+        bam: a pysam.AlignmentFile
+        sites: list of (contig, start, stop, ref, alt) tuples
+    Returns:
+        List of dictionaries mapping each base in ACGT to its count, one per site
+    """
+
+    def check_read(read):
+        if read.is_duplicate or read.is_secondary or read.is_qcfail or read.is_supplementary or read.is_unmapped or (read.mapping_quality < MIN_MAPPING_QUALITY):
+            return False
+        else:
+            return True
+
+    counts = []
+    for contig, start, stop, ref, alt in sites:
+        coverage = bam.count_coverage(contig, start, stop, quality_threshold=MIN_BASE_QUALITY, read_callback=check_read)
+        counts.append({base: int(coverage[i][0]) for i, base in enumerate("ACGT")})
+    return counts
+
+def count_sites_pileup(bam, sites):
+    """
+    Count bases at all sites with one streaming pileup per cluster of nearby sites. Reads are filtered
+    by flag, mapping quality and base quality inside htslib, so there is no per-read python callback
+    Arguments:
+        bam: a pysam.AlignmentFile
+        sites: list of (contig, start, stop, ref, alt) tuples
+    Returns:
+        List of dictionaries mapping each base in ACGT to its count, one per site (same order as sites)
+    """
+    counts = [dict.fromkeys("ACGT", 0) for _ in sites]
+
+    # sort sites once and group them into clusters, each cluster is swept by a single pileup
+    order = sorted(range(len(sites)), key=lambda i: (sites[i][0], sites[i][1]))
+    clusters = []
+    for i in order:
+        contig, start = sites[i][0], sites[i][1]
+        if len(clusters) > 0 and clusters[-1][0] == contig and start - clusters[-1][2] <= PILEUP_MAX_GAP:
+            clusters[-1][2] = start
+            clusters[-1][3].setdefault(start, []).append(i)
+        else:
+            clusters.append([contig, start, start, {start: [i]}])
+
+    for contig, first, last, targets in clusters:
+        columns = bam.pileup(contig, first, last + 1,
+                             truncate=True,
+                             stepper='samtools',
+                             flag_filter=PILEUP_FLAG_FILTER,
+                             min_mapping_quality=MIN_MAPPING_QUALITY,
+                             min_base_quality=MIN_BASE_QUALITY,
+                             ignore_overlaps=False,
+                             ignore_orphans=False,
+                             compute_baq=False,
+                             max_depth=PILEUP_MAX_DEPTH)
+        for column in columns:
+            if column.reference_pos not in targets:
+                continue
+            bases = Counter(base.upper() for base in column.get_query_sequences())
+            for i in targets[column.reference_pos]:
+                for base in "ACGT":
+                    counts[i][base] = bases[base]
+    return counts
+
+def _get_counts_job(job):
+    bam_path, sites, count_mode = job
+    return get_counts(bam_path, sites, False, count_mode)
+
+def get_counts_parallel(bam_paths, vcf_path, num_workers, verbose, count_mode='coverage', temp_dir=None, cache_size=2048):
+    """
+    Get reference and alternate allele counts for several bam files at once. The vcf is parsed once into a site
+    table (see load_sites), which is split into genomic chunks, and every (bam, chunk) job is scheduled on a single
+    process pool, each worker opening its own bam file
+    Arguments:
+        bam_paths: list of strings
+        vcf_path: a string
+        num_workers: an integer
+        verbose: a boolean
+        count_mode: a string (one of {coverage, pileup})
+        temp_dir: a string or None - reuse the counts of bam files cached in temp_dir (and cache new ones). Counts
+            are keyed by the bam and vcf files and the read filters, so the counts of clone bams are shared by all
+            liquid samples counted against the same vcf
+        cache_size: an integer (megabytes)
+    Returns:
+        List of pandas dataframes (one per bam file, same order as bam_paths) - see get_counts
+    """
+    filters = (COUNTS_CACHE_VERSION, count_mode, PILEUP_FLAG_FILTER, MIN_MAPPING_QUALITY, MIN_BASE_QUALITY)
+    keys = [make_key(file_identity(bam_path), file_identity(vcf_path), filters) for bam_path in bam_paths]
+    counts = [load_cached(temp_dir, 'snv_counts', key) if temp_dir is not None else None for key in keys]
+    pending = [i for i, cached in enumerate(counts) if cached is None]
+    if len(pending) < len(bam_paths):
+        _print(f"Loading counts of {len(bam_paths) - len(pending)} bam files from cache", verbose)
+    if len(pending) == 0:
+        return [pd.DataFrame(cached) for cached in counts]
+
+    regions = split_sites(load_sites(vcf_path, verbose))
+    jobs = [(bam_paths[i], region, count_mode) for i in pending for region in regions]
+
+    _print(f"Getting counts from {len(pending)} bam files at SNV positions in {vcf_path} ({len(jobs)} jobs, {num_workers} workers)", verbose)
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_get_counts_job, jobs))
+    else:
+        results = [_get_counts_job(job) for job in jobs]
+
+    # merge chunks back in region order so the output matches a single pass over the vcf
+    for j, i in enumerate(pending):
+        chunks = [chunk for chunk in results[j*len(regions):(j+1)*len(regions)] if len(chunk) > 0]
+        counts[i] = pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame([], columns=COUNTS_COLUMNS)
+        if temp_dir is not None:
+            store_cached(temp_dir, 'snv_counts', keys[i], {column: counts[i][column].to_numpy(dtype=np.int64) for column in COUNTS_COLUMNS}, cache_size)
+    return [pd.DataFrame(cached) if isinstance(cached, dict) else cached for cached in counts]
+
+def process_counts(_counts_liquid, _counts_clones, bins, cn_profiles, verbose):
     """
     Get ref and alt counts from liquid biopsy and estimates for mutant copies for each clone
     Arguments:
         counts_liquid: a pandas dataframe
         counts_clones: list of pandas dataframes
-        cn_profiles: a numpy array
+        bins: (n, 3) integer ndarray - chr, start, end of the copy-number bins
+        cn_profiles: (n, num_clones) ndarray
     Returns:
         ndarray with shape (L, 2+K) - L=length of intersection of SNV positions across all dfs, 2+K=ref and alt counts for liquid biopsy and K estimates for mutant copies for each clone (excluding normal)
     """
 
-    def valid(event_id, _ranges):
-        """
-        Check if the genomic position described by event_id is included in bins defined by ranges
-        Arguments:
-            event_id: a string
-            _ranges: a dictionary
-        Returns:
-            boolean value indicating whether the genomic position described by event_id is included in bins defined by ranges
-        """
-        event_id_list = event_id.split(':') 
-        chromosome, pos = int(event_id_list[0]), int(event_id_list[1])
-        return _ranges[chromosome][0] <= pos <= _ranges[chromosome][1]    
-
     def drop_duplicates_and_0_reads(counts_df):
-        return counts_df.drop_duplicates(subset=['event_id']).drop(counts_df[counts_df.ref_counts + counts_df.alt_counts == 0].index)
+        return counts_df.drop_duplicates(subset=['chr', 'pos']).drop(counts_df[counts_df.ref_counts + counts_df.alt_counts == 0].index)
 
-    def compute_vaf(row):
-        return row['alt_counts'] / (row['ref_counts'] + row['alt_counts'])
-
-    def get_chr(event_id):
+    def assign_bins(counts_df):
         """
-        Given an event_id (ex. 1:3005513), return chromosome component
+        Find the CN profile bin containing each SNV
         Arguments:
-            event_id: a pandas Series
+            counts_df: a pandas dataframe
         Returns:
-            string representing chromosome
+            int64 ndarray with the row of bins containing each SNV (-1 if no bin contains it)
         """
-        return event_id.split(':')[0]
-
-    def get_pos(event_id):
-        """
-        Given an event_id (ex. 1:3005513), return position component
-        Arguments:
-            event_id: a pandas Series
-        Returns:
-            string representing position
-        """
-        return event_id.split(':')[1]
+        chromosome, pos = counts_df['chr'].to_numpy(dtype=np.int64), counts_df['pos'].to_numpy(dtype=np.int64)
+        idx = np.searchsorted(bin_keys, (chromosome << 32) | pos, side='right') - 1
+        rows = bin_order[np.maximum(idx, 0)]
+        found = (idx >= 0) & (bins[rows, 0] == chromosome) & (pos <= bins[rows, 2])
+        return np.where(found, rows, -1)
 
     _print("Processing counts from liquid biopsy and estimating mutant copies for each clone", verbose)
 
-    # load CN profiles
-    cn_profiles = pd.DataFrame(data=_cn_profiles)
-
-    # get genomic intervals spanned by CN profile bins for each chromosome
-    ranges = m()
-    for chromosome in cn_profiles.iloc[:, 0].unique().astype(int):
-        subset = cn_profiles.loc[cn_profiles.iloc[:, 0].astype(int) == chromosome]
-        ranges = ranges.set(chromosome, (int(subset.iloc[0, 1]), int(subset.iloc[-1, 2])))  # store min and max in tuple
+    # sorted interval index over the CN profile bins - (chromosome, start) packed into one sortable integer key
+    bins = np.asarray(bins, dtype=np.int64)
+    bin_order = np.lexsort((bins[:, 1], bins[:, 0]))
+    bin_keys = (bins[bin_order, 0] << 32) | bins[bin_order, 1]
 
     # drop duplicates and rows with 0 reads
     counts_liquid = drop_duplicates_and_0_reads(_counts_liquid)
     counts_clones = [drop_duplicates_and_0_reads(_counts_clone) for _counts_clone in _counts_clones]
 
-    # remove SNVs outside of genomic intervals spanned by CN profile bins
-    counts_liquid = counts_liquid.loc[counts_liquid['event_id'].apply(valid, args=(ranges,))]
-    counts_clones = [counts_clone.loc[counts_clone['event_id'].apply(valid, args=(ranges,))] for counts_clone in counts_clones]
-    
-    # construct a df where keys are chr:pos and vals are a dict containing clone VAFs
+    # remove SNVs outside of the CN profile bins
+    counts_liquid = counts_liquid.assign(bin=assign_bins(counts_liquid))
+    counts_liquid = counts_liquid.loc[counts_liquid['bin'] >= 0]
+    counts_clones = [counts_clone.loc[assign_bins(counts_clone) >= 0] for counts_clone in counts_clones]
+
+    # construct a df where keys are (chr, pos) and vals are a dict containing clone VAFs
     # ex.
-    # chr:pos    A    B    C
-    # 1:77655    .8   .4   0
-    #   ...     ...  ...  ...
-    # 22:4932    .4   .25  .5
+    # chr  pos     A    B    C
+    # 1    77655   .8   .4   0
+    #  ...  ...   ...  ...  ...
+    # 22   4932    .4   .25  .5
 
     # compute VAF for each clone and store in column
     uppercase_letters = list(string.ascii_uppercase) # for naming clones
-    for i, counts_clone in enumerate(counts_clones):
-        counts_clone[uppercase_letters[i]] = counts_clone.apply(compute_vaf, axis=1)
-        counts_clone.drop(columns=['ref_counts', 'alt_counts'], inplace=True) # drop ref and alt counts
+    vafs = [pd.DataFrame({'chr': counts_clone['chr'].to_numpy(),
+                          'pos': counts_clone['pos'].to_numpy(),
+                          uppercase_letters[i]: counts_clone['alt_counts'].to_numpy() / (counts_clone['ref_counts'].to_numpy() + counts_clone['alt_counts'].to_numpy())})
+            for i, counts_clone in enumerate(counts_clones)]
 
     # join all liquid and clone vafs
-    counts_liquid_and_vafs = reduce(lambda left, right: pd.merge(left, right, on=['event_id'], how='inner'), counts_clones + [counts_liquid])
-
-    # get corresponding clone CN values at SNV positions
-    cn_row = 0
-    cns = []
-    for i in range(counts_liquid_and_vafs.shape[0]):
-        # iterate until we get to the right chromosome
-        while int(get_chr(counts_liquid_and_vafs['event_id'].iloc[i])) != int(cn_profiles.iloc[cn_row, 0]):
-            cn_row += 1
-        # iterate until we get to the right position
-        while int(get_pos(counts_liquid_and_vafs['event_id'].iloc[i])) > cn_profiles.iloc[cn_row, 2]:
-            cn_row += 1
-        cns.append(cn_profiles.iloc[cn_row, 3:cn_profiles.shape[1]-1])  # don't need normal so omit last column
-    cns = np.array(cns)
-
-    mutant_copies = counts_liquid_and_vafs.drop(columns=['event_id', 'ref_counts', 'alt_counts']).to_numpy() * cns
+    counts_liquid_and_vafs = reduce(lambda left, right: pd.merge(left, right, on=['chr', 'pos'], how='inner'), vafs + [counts_liquid])
+
+    # get corresponding clone CN values at SNV positions - don't need normal so omit last column
+    cns = np.asarray(cn_profiles[counts_liquid_and_vafs['bin'].to_numpy(), :-1], dtype=float)
+
+    mutant_copies = counts_liquid_and_vafs[uppercase_letters[:len(vafs)]].to_numpy() * cns
 
     # construct an Lx(2+K) matrix (L=num SNVs post filtering, 2+K=ref & alt counts for liquid biopsy + mutant copies estimates at SNV l for each clone j
     res = np.c_[counts_liquid_and_vafs[['ref_counts', 'alt_counts']].to_numpy(), mutant_copies]
@@ -0,0 +1,209 @@
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+IMPORT_TIME_PREFIX = 'import time:'
+COMPILE_EVENT_PREFIX = '/jax/core/compile/'  # jax.monitoring events of tracing, lowering and compiling
+
+# state of the stage profiler while profiled is active
+_profile = None
+_listening = False
+
+
+def import_times(module):
+    """
+    Import a module in a fresh interpreter with -X importtime
+    Arguments:
+        module: a string
+    Returns:
+        List of (module name, self time in ms, cumulative time in ms) in the order imports finished
+    """
+    # run from the directory holding the src package so it is importable without being installed
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, cwd=package_root)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed: {result.stderr.strip().splitlines()[-1]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX) or 'self [us]' in line:
+            continue
+        self_time, cumulative_time, name = line[len(IMPORT_TIME_PREFIX):].split('|')
+        times.append((name.strip(), int(self_time) / 1000, int(cumulative_time) / 1000))
+    return times
+
+def profile_startup(modules, top):
+    """
+    Print the import time of each module and of the slowest packages and src modules it imports (each module is
+    imported in a fresh interpreter, so it pays for all of its dependencies)
+    Arguments:
+        modules: list of strings
+        top: an integer - number of slowest imports listed per module
+    """
+    for module in modules:
+        times = import_times(module)
+        total = next(cumulative for name, _, cumulative in reversed(times) if name == module)
+        print(f'{module}: {total:.0f} ms')
+        # submodules of third party packages are left out, their time is part of the package's
+        dependencies = [entry for entry in times if entry[0] != module and ('.' not in entry[0] or entry[0].startswith('src.'))]
+        for name, self_time, cumulative in sorted(dependencies, key=lambda entry: -entry[2])[:top]:
+            print(f'  {cumulative:8.0f} ms  {self_time:6.0f} ms self  {name}')
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process (Linux only, elsewhere the peak covers the whole process)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss():
+    """
+    Returns:
+        Peak resident set size in MB since the last reset_peak_rss
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _record_compilation(event, duration, **kwargs):
+    if _profile is None or _profile['pid'] != os.getpid() or not event.startswith(COMPILE_EVENT_PREFIX):
+        return
+    # events can be nested (ex. a function compiled while an outer one is traced), so only the part of an event
+    # that is not covered by the events recorded before it is counted - the union of their intervals
+    end = time.perf_counter()
+    start = end - duration
+    intervals = _profile['compile_intervals']
+    overlapping = [(s, e) for s, e in intervals if e > start]
+    uncovered = duration - sum(e - max(s, start) for s, e in overlapping)
+    intervals[len(intervals) - len(overlapping):] = [(min([start] + [s for s, _ in overlapping]), end)]
+    for open_stage in _profile['open']:
+        open_stage['compile_seconds'] += max(uncovered, 0)
+
+def _track_compilation():
+    """
+    Listen to jax's compilation events once jax has been imported (it is never imported just for profiling)
+    """
+    global _listening
+    if not _listening and 'jax' in sys.modules:
+        import jax.monitoring
+        jax.monitoring.register_event_duration_secs_listener(_record_compilation)
+        _listening = True
+
+def _write_trace():
+    """
+    Write the finished stages as complete events and the open ones as begin events of the chrome trace event
+    format, so a killed run still shows the stage it was stuck in
+    """
+    events = []
+    for record in _profile['stages'] + _profile['open']:
+        event = {'name': record['name'], 'cat': 'stage', 'ph': 'X' if 'seconds' in record else 'B',
+                 'ts': record['start'] * 1e6, 'pid': _profile['pid'], 'tid': 0,
+                 'args': {k: v for k, v in record.items() if k not in ['name', 'start', 'clock']}}
+        if 'seconds' in record:
+            event['dur'] = record['seconds'] * 1e6
+        events.append(event)
+    # written to a temporary file and renamed, so readers polling a running job never see a partial trace
+    temp_path = f"{_profile['path']}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'argv': sys.argv}}, f, indent=1, default=float)
+    os.replace(temp_path, _profile['path'])
+
+def read_stages(path):
+    """
+    Read the stages of a trace written by profiled
+    Arguments:
+        path: a string
+    Returns:
+        List of dictionaries with the name, start (seconds after the trace started) and recorded fields of each
+        stage in the order they started - stages that are still running have no seconds
+    """
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    return sorted(({'name': event['name'], 'start': event['ts'] / 1e6, **event['args']} for event in events), key=lambda stage: stage['start'])
+
+@contextlib.contextmanager
+def stage(name, **sizes):
+    """
+    Time a pipeline stage when profiling is enabled (see profiled). Wall time, cpu time of this process and of
+    finished child processes, peak RSS and compile time are recorded along with sizes
+    Arguments:
+        name: a string
+        sizes: sizes of the stage's inputs (ex. bins=1000) - more can be added to the yielded dictionary
+    Returns:
+        Context manager yielding a dictionary for sizes known once the stage has run
+    """
+    if _profile is None or _profile['pid'] != os.getpid():
+        # profiling is disabled or this is a worker process forked from the profiled one
+        yield sizes
+        return
+
+    _track_compilation()
+    parent = _profile['open'][-1] if len(_profile['open']) > 0 else None
+    if parent is not None:
+        parent['peak_rss_mb'] = max(parent['peak_rss_mb'], get_peak_rss())
+    reset_peak_rss()
+    record = {'name': name, 'start': time.time() - _profile['start'], 'clock': (time.perf_counter(), os.times()),
+              'peak_rss_mb': 0, 'compile_seconds': 0, **sizes}
+    _profile['open'].append(record)
+    _write_trace()
+
+    profiler = None
+    if name in _profile['cprofile_stages']:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(get_cprofile_path(_profile['path'], name))
+        start, start_times = record.pop('clock')
+        times = os.times()
+        record['seconds'] = time.perf_counter() - start
+        record['cpu_seconds'] = max(times.user + times.system - start_times.user - start_times.system, 0)
+        record['child_cpu_seconds'] = max(times.children_user + times.children_system - start_times.children_user - start_times.children_system, 0)
+        # the peak since the last reset covers this stage from its last nested stage on
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], get_peak_rss())
+        if parent is not None:
+            parent['peak_rss_mb'] = max(parent['peak_rss_mb'], record['peak_rss_mb'])
+        _profile['open'].remove(record)
+        _profile['stages'].append(record)
+        _write_trace()
+
+def get_cprofile_path(path, name):
+    return os.path.splitext(path)[0] + f'.{name}.prof'
+
+@contextlib.contextmanager
+def profiled(path, cprofile_stages=()):
+    """
+    Enable stage profiling for the duration of the context and write a chrome trace event file to path (open in
+    chrome://tracing or https://ui.perfetto.dev). The trace is rewritten as stages start and finish
+    Arguments:
+        path: a string or None (profiling disabled)
+        cprofile_stages: list of stage names that are also profiled with cProfile - stats are written to
+            <path stem>.<stage>.prof (see get_cprofile_path)
+    """
+    global _profile
+    if path is None:
+        yield
+        return
+    _profile = {'path': path, 'pid': os.getpid(), 'start': time.time(), 'cprofile_stages': set(cprofile_stages), 'stages': [], 'open': [],
+                'compile_intervals': []}
+    try:
+        with stage('total'):
+            yield
+    finally:
+        _profile = None
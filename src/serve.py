@@ -0,0 +1,289 @@
+import json
+import multiprocessing
+import os
+import signal
+import socketserver
+import stat
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.profiling import read_stages
+from src.utils import _print
+
+PRELOADS = ['jax', 'pysam', 'hmmcopy']
+
+
+def _preload_worker(preload, num_devices, verbose):
+    """
+    Import the backends listed in preload once in a new worker, so jobs do not pay for them (a backend that cannot
+    be loaded is reported and skipped - jobs that need it fail on their own). The number of XLA host devices is set
+    first, as it cannot change once JAX has initialised its backend (see inference.setup_chains)
+    """
+    if num_devices > 1:
+        import numpyro
+        numpyro.set_host_device_count(num_devices)
+    for name in preload:
+        try:
+            if name == 'jax':
+                import src.inference
+            elif name == 'pysam':
+                import src.process_snvs
+                import pysam
+            elif name == 'hmmcopy':
+                # R and HMMcopy stay loaded in the worker, later importr calls only look the package up
+                from rpy2.robjects.packages import importr
+                importr('HMMcopy')
+        except Exception as e:
+            _print(f'Worker {os.getpid()} could not preload {name}: {e}', verbose)
+
+def _worker_ready():
+    return os.getpid()
+
+def _run_job(kwargs, marker):
+    """
+    Run one job in a worker
+    Arguments:
+        kwargs: dictionary of keyword arguments of main.run
+        marker: a string - path of the file written when the job starts running
+    Returns:
+        Dictionary with the start and end time of the job
+    """
+    import src.main
+    started = time.time()
+    with open(marker, 'w') as f:
+        f.write(str(os.getpid()))
+    src.main.run(**kwargs)
+    return {'started': started, 'finished': time.time()}
+
+def parse_job(params):
+    """
+    Turn the parameters of a job into the arguments of main.run - the job gives the options of the run command by
+    their argument name (ex. {"liquid_bam": "sample.bam", "num_samples": 2000, "clone_bams": ["A.bam", "B.bam"]}) and
+    they are parsed by the run command, so defaults, types and required options are the same as on the command line
+    Arguments:
+        params: a dictionary
+    Returns:
+        Dictionary of keyword arguments of main.run
+    """
+    import click
+    from src.cli import run as run_command
+    if not isinstance(params, dict):
+        raise RuntimeError('A job must be a JSON object of run parameters')
+    options = {option.name: option for option in run_command.params}
+    unknown = set(params) - set(options)
+    if len(unknown) > 0:
+        raise RuntimeError(f"Unknown run parameters {', '.join(sorted(unknown))}")
+
+    args = []
+    for name, value in params.items():
+        if value is None:
+            continue
+        flag = max(options[name].opts, key=len)
+        for item in value if isinstance(value, list) else [value]:
+            args += [flag, str(item)]
+    try:
+        with run_command.make_context('run', args) as context:
+            return context.params
+    except click.ClickException as e:
+        raise RuntimeError(e.format_message())
+
+def get_num_devices(num_chains):
+    """
+    Returns:
+        The number of XLA host devices parallel chains run on (one per chain, up to the number of cores)
+    """
+    return min(num_chains, os.cpu_count() or 1)
+
+class JobQueue:
+    """
+    Jobs submitted to a pool of worker processes. Workers live as long as the queue, so backends imported and NUTS
+    kernels compiled by one job (see inference.get_sampler) are reused by the later jobs of the same worker - jobs
+    pad their inputs to size buckets (pad_buckets) unless they set it, so inputs of similar size share a kernel.
+    Workers are created with the devices of num_chains parallel chains, which jobs cannot change, and jobs count
+    reads and SNVs in their worker (num_workers of 1), as forking pools from a worker running JAX threads can deadlock
+    """
+    def __init__(self, num_workers, jobs_dir, preload, verbose, num_chains=1):
+        self.num_workers = num_workers
+        self.num_devices = get_num_devices(num_chains)
+        self.jobs_dir = jobs_dir
+        self.verbose = verbose
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # workers are forked from a clean forkserver process, as a process that has loaded JAX cannot fork safely
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('forkserver'),
+                                            initializer=_preload_worker, initargs=(preload, self.num_devices, verbose))
+        # the pool starts a worker per task while none is idle, so this starts (and preloads) all of them up front
+        pids = set(future.result() for future in [self.executor.submit(_worker_ready) for _ in range(num_workers)])
+        _print(f'Started {len(pids)} workers', verbose)
+
+    def submit(self, params):
+        """
+        Arguments:
+            params: dictionary of run parameters (see parse_job)
+        Returns:
+            The job's description (see describe)
+        """
+        if isinstance(params, dict):
+            params = {'pad_buckets': True, **params}
+        kwargs = parse_job(params)
+        if kwargs['num_workers'] != 1:
+            raise RuntimeError('Served jobs run in a single process (num_workers must be 1) - start the server with more '
+                               'workers (serve --num-workers) to run more jobs at the same time')
+        if kwargs['chain_method'] == 'parallel' and get_num_devices(kwargs['num_chains']) > self.num_devices:
+            raise RuntimeError(f"Workers run at most {self.num_devices} parallel chains - start the server with "
+                               f"serve --num-chains {kwargs['num_chains']} or use chain_method sequential or vectorized")
+        # ids are unique across restarts, as the jobs directory outlives the server
+        job_id = uuid.uuid4().hex[:12]
+        # every job is profiled, its trace shows how far it got
+        kwargs['profile'] = os.path.join(self.jobs_dir, f'{job_id}.json')
+        job = {'id': job_id, 'params': params, 'trace': kwargs['profile'], 'marker': os.path.join(self.jobs_dir, f'{job_id}.started'),
+               'submitted': time.time()}
+        for path in [job['trace'], job['marker']]:
+            if os.path.exists(path):
+                os.remove(path)
+        with self.lock:
+            job['future'] = self.executor.submit(_run_job, kwargs, job['marker'])
+            self.jobs[job_id] = job
+        _print(f'Queued job {job_id} ({params.get("liquid_bam")})', self.verbose)
+        return self.describe(job)
+
+    def get_state(self, job):
+        future = job['future']
+        if future.done():
+            return 'failed' if future.exception() is not None else 'done'
+        return 'running' if os.path.exists(job['marker']) else 'queued'
+
+    def describe(self, job):
+        """
+        Returns:
+            Dictionary with the job's id, state (one of {queued, running, done, failed}), parameters, submission time
+            and the stages it has run so far (see profiling.read_stages) - plus start and end times once it is
+            done and the error if it failed
+        """
+        state = self.get_state(job)
+        description = {'id': job['id'], 'state': state, 'params': job['params'], 'submitted': job['submitted'],
+                       'stages': read_stages(job['trace']) if os.path.exists(job['trace']) else []}
+        if state == 'done':
+            description.update(job['future'].result())
+        elif state == 'failed':
+            description['error'] = str(job['future'].exception())
+        return description
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return None if job is None else self.describe(job)
+
+    def list_jobs(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [self.describe(job) for job in jobs]
+
+    def get_status(self):
+        """
+        Returns:
+            Dictionary with the number of workers and the number of jobs in each state
+        """
+        with self.lock:
+            jobs = list(self.jobs.values())
+        states = [self.get_state(job) for job in jobs]
+        return {'workers': self.num_workers, **{state: states.count(state) for state in ['queued', 'running', 'done', 'failed']}}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def make_handler(queue, verbose):
+    """
+    Returns:
+        HTTP request handler class serving the queue - POST /jobs submits a job, GET /jobs lists the jobs, GET
+        /jobs/<id> describes one job and GET /status reports the queue depth
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            content = json.dumps(body, default=float).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            path = self.path.rstrip('/')
+            if path == '/status':
+                self.send_json(200, queue.get_status())
+            elif path == '/jobs':
+                self.send_json(200, queue.list_jobs())
+            elif path.startswith('/jobs/'):
+                job = queue.get_job(path[len('/jobs/'):])
+                if job is None:
+                    self.send_json(404, {'error': f'Unknown job {path[len("/jobs/"):]}'})
+                else:
+                    self.send_json(200, job)
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/jobs':
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.send_json(202, queue.submit(params))
+            except (ValueError, RuntimeError) as e:
+                self.send_json(400, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            # the default writes the client address, which Unix sockets do not have
+            _print(f'{self.command} {self.path} - ' + format % args, verbose)
+
+    return Handler
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(socket, port, num_workers, num_chains, jobs_dir, preload, verbose):
+    """
+    Run jobs with the parameters of the run command on a pool of warm worker processes, submitted over HTTP on a
+    Unix socket or on a localhost port, until interrupted
+    Arguments:
+        socket: a string or None - path of the Unix socket (port is used if None)
+        port: an integer
+        num_workers: an integer - number of jobs run at the same time
+        num_chains: an integer - largest number of parallel chains of a job
+        jobs_dir: a string - directory the stage trace of each job is written to
+        preload: a string - comma separated backends imported by every worker at startup (any of PRELOADS)
+        verbose: a boolean
+    """
+    preload = [name for name in preload.split(',') if name != '']
+    unknown = set(preload) - set(PRELOADS)
+    if len(unknown) > 0:
+        raise RuntimeError(f"Unknown backends {', '.join(sorted(unknown))} (must be some of {', '.join(PRELOADS)})")
+    if socket is not None and os.path.exists(socket):
+        if not stat.S_ISSOCK(os.stat(socket).st_mode):
+            raise RuntimeError(f"{socket} exists and is not a socket")
+        os.remove(socket)  # left behind by a server that did not shut down cleanly
+    os.makedirs(jobs_dir, exist_ok=True)
+
+    _print(f'Starting {num_workers} workers (preloading {", ".join(preload) or "nothing"})', verbose)
+    queue = JobQueue(num_workers, jobs_dir, preload, verbose, num_chains)
+    handler = make_handler(queue, verbose)
+    server = UnixHTTPServer(socket, handler) if socket is not None else ThreadingHTTPServer(('127.0.0.1', port), handler)
+    print(f"Serving on {socket if socket is not None else f'http://127.0.0.1:{port}'}")
+    # a service manager stops the server with SIGTERM - shut down as on ctrl-c (workers are already started and
+    # keep the default handler)
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.shutdown()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
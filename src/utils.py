@@ -1,30 +1,123 @@
 import os
 import sys
 import numpy as np
-import pandas as pd
 import string
 import random
 
+CHUNK_ROWS = 65536  # rows of a copy-number profile file parsed at a time
+CN_MODELS = ['cn', 'base']  # names of the model without SNVs (see inference.get_model)
+
+
+def read_table(path):
+    """
+    Read a tab delimited numeric table with pandas' C parser - same result as np.genfromtxt(path, delimiter='\t')
+    (fields that are not numbers, ex. chromosome X, become nan and single column files give 1D arrays)
+    Arguments:
+        path: a string
+    Returns:
+        ndarray of floats
+    """
+    import pandas as pd
+    table = pd.read_csv(path, sep='\t', header=None, comment='#', float_precision='round_trip')
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in table.dtypes):
+        table = table.apply(pd.to_numeric, errors='coerce')
+    values = table.to_numpy(dtype=float, copy=True)  # writable, callers modify the arrays in place
+    return values.squeeze(axis=1) if values.shape[1] == 1 else values
+
+def get_cn_dtype(columns):
+    """
+    Arguments:
+        columns: list of ndarrays of copy numbers
+    Returns:
+        The smallest unsigned integer dtype holding the copy numbers if they are all non-negative integers, otherwise float32
+    """
+    largest = 0
+    for column in columns:
+        if column.size == 0:
+            continue
+        if column.dtype.kind == 'f' and not (np.all(np.isfinite(column)) and np.all(column == np.floor(column))):
+            return np.dtype(np.float32)
+        if column.min() < 0:
+            return np.dtype(np.float32)
+        largest = max(largest, int(column.max()))
+    return np.min_scalar_type(largest)
+
+def split_cn_profiles(table):
+    """
+    Split a copy-number profile table (chr, start, end, one column per clone and the normal) into int32 bin
+    coordinates and copy numbers of the smallest dtype holding them (see get_cn_dtype). Columns are converted one
+    at a time, so no float64 copy of the whole table is made
+    Arguments:
+        table: (n, 3+num_clones) ndarray or pandas dataframe
+    Returns:
+        Two ndarrays - (n, 3) int32 bins (chr is -1 where the coordinates are not numbers, ex. chromosome X) and
+        (n, num_clones) copy numbers
+    """
+    import pandas as pd
+    table = pd.DataFrame(table)
+    columns = [pd.to_numeric(table[column], errors='coerce').to_numpy() for column in table.columns]
+
+    bins = np.zeros((len(table), 3), dtype=np.int32)
+    numeric = np.ones(len(table), dtype=bool)
+    for i, column in enumerate(columns[:3]):
+        if column.dtype.kind == 'f':
+            numeric &= ~np.isnan(column)
+            column = np.where(np.isnan(column), 0, column)
+        bins[:, i] = column
+    bins[~numeric] = [-1, 0, 0]
+
+    cn_profiles = np.empty((len(table), len(columns) - 3), dtype=get_cn_dtype(columns[3:]))
+    for i, column in enumerate(columns[3:]):
+        cn_profiles[:, i] = column
+    return bins, cn_profiles
+
+def read_cn_profiles(path):
+    """
+    Read a --cn-profiles-path bed file into int32 bin coordinates and compact copy numbers (see split_cn_profiles)
+    Arguments:
+        path: a string
+    Returns:
+        Two ndarrays - (n, 3) bins and (n, num_clones) copy numbers
+    """
+    import pandas as pd
+    # parsed in chunks so only one chunk is held as a pandas table - np.concatenate promotes the chunks' copy number
+    # dtypes to one holding all of them
+    chunks = [split_cn_profiles(chunk) for chunk in pd.read_csv(path, sep='\t', header=None, comment='#', float_precision='round_trip', chunksize=CHUNK_ROWS)]
+    return np.concatenate([bins for bins, _ in chunks]), np.concatenate([cn_profiles for _, cn_profiles in chunks])
 
 def load_data(liquid_bam, cn_profiles_path):
-    raw_data = np.genfromtxt(liquid_bam, delimiter='\t')
-    raw_cn_profiles = np.genfromtxt(cn_profiles_path, delimiter='\t')
-    return raw_data, raw_cn_profiles
+    """
+    Returns:
+        Three ndarrays - (n,) float32 liquid log-ratios, (n, 3) int32 bins and (n, num_clones) copy numbers
+    """
+    raw_data = read_table(liquid_bam).astype(np.float32)
+    raw_bins, raw_cn_profiles = read_cn_profiles(cn_profiles_path)
+    return raw_data, raw_bins, raw_cn_profiles
 
 def load_counts(counts_mat):
-    return np.genfromtxt(counts_mat, delimiter='\t')
+    return read_table(counts_mat)
     
 def get_extension(file_path):
     return os.path.splitext(file_path)[1]
 
-def save_results(path, sampler_obj, num_subclones, verbose):
-    _print('Saving results', verbose)
-    clones = list(string.ascii_uppercase)[:num_subclones] + ['normal']
-    samples = sampler_obj.get_samples()
-    rhos = pd.DataFrame(list(samples['rho']),columns=clones, dtype = float)
-    samples.pop('rho')
-    samples = pd.DataFrame.from_dict(samples).join(rhos).to_csv(path, index=False)
-        
+def group_rows(rows):
+    """
+    Find the unique rows of a 2D array - same result as np.unique(rows, axis=0, return_inverse=True) but
+    sorts with a lexsort over the columns, which is much faster than np.unique's sort of the rows as void records
+    Arguments:
+        rows: (n, k) ndarray
+    Returns:
+        Two ndarrays - (u, k) unique rows in sorted order and (n,) index of each row in the unique rows
+    """
+    if len(rows) == 0:
+        return rows, np.zeros(0, dtype=np.int64)
+    order = np.lexsort(rows.T[::-1])
+    sorted_rows = rows[order]
+    is_first = np.r_[True, np.any(sorted_rows[1:] != sorted_rows[:-1], axis=1)]
+    inverse = np.empty(len(rows), dtype=np.int64)
+    inverse[order] = np.cumsum(is_first) - 1
+    return sorted_rows[is_first], inverse
+
 def get_random_string(length=10):
     """
     generate a random string - used to define unique file paths if running LiquidBayes in parallel
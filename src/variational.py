@@ -0,0 +1,94 @@
+import numpy as np
+import jax
+from jax import random
+import numpyro
+from numpyro.infer import SVI, Trace_ELBO
+from numpyro.infer.autoguide import AutoLowRankMultivariateNormal, AutoLaplaceApproximation
+
+from src.inference import get_model
+from src.utils import _print
+
+
+def fit_guide(model_fn, guide, model_args, num_steps, learning_rate, rng_key, verbose, tol=1e-4, check_every=500):
+    """
+    Optimise the ELBO in chunks of check_every steps and stop early once the mean loss of a chunk changes by less
+    than tol (relative) from the previous chunk
+    Arguments:
+        model_fn: a numpyro model
+        guide: a numpyro autoguide
+        model_args: tuple
+        num_steps: an integer - maximum number of optimisation steps
+        learning_rate: a float
+        rng_key: a jax PRNGKey
+        verbose: a boolean
+    Returns:
+        Fitted guide parameters
+    """
+    svi = SVI(model_fn, guide, numpyro.optim.Adam(learning_rate), Trace_ELBO())
+    state = svi.init(rng_key, *model_args)
+
+    def step(state, _):
+        return svi.update(state, *model_args)
+
+    run_chunk = jax.jit(lambda state: jax.lax.scan(step, state, None, length=check_every))
+
+    previous_loss = None
+    for start in range(0, num_steps, check_every):
+        state, losses = run_chunk(state)
+        loss = float(np.mean(losses))
+        if previous_loss is not None and abs(loss - previous_loss) <= tol * abs(previous_loss):
+            _print(f'ELBO converged after {start + check_every} steps (loss {loss:.2f})', verbose)
+            break
+        previous_loss = loss
+    else:
+        _print(f'ELBO did not converge in {num_steps} steps (loss {loss:.2f})', verbose)
+    return svi.get_params(state)
+
+def run_variational(model,
+                    data,
+                    cn_profiles,
+                    counts,
+                    engine,
+                    num_samples,
+                    num_steps,
+                    learning_rate,
+                    iteration,
+                    verbose,
+                    compress=False,
+                    thin=1):
+    """
+    Approximate the posterior with an autoguide instead of NUTS - svi fits a low rank multivariate normal, laplace
+    a normal at the MAP estimate (both in the unconstrained space, so rho stays on the simplex)
+    Arguments:
+        model: a string
+        data: ndarray
+        cn_profiles: ndarray
+        counts: ndarray or None
+        engine: a string (one of {svi, laplace})
+        num_samples: an integer - number of draws from the fitted guide
+        num_steps: an integer - maximum number of optimisation steps
+        learning_rate: a float
+        iteration: an integer (seed)
+        verbose: a boolean
+        compress: a boolean - fit the compressed counterpart of the model (see inference.compress_inputs)
+        thin: an integer - keep every thin-th draw like MCMC thinning (guide draws are independent, so fewer are drawn)
+    Returns:
+        Dictionary with sites rho and tau, each of shape (1, num_samples, ...) like MCMC samples grouped by chain
+    """
+    _print('Performing {} inference using {} model'.format(engine, model), verbose)
+    model_fn, model_args = get_model(model, data, cn_profiles, counts, compress)
+
+    if engine == 'svi':
+        guide = AutoLowRankMultivariateNormal(model_fn)
+    elif engine == 'laplace':
+        guide = AutoLaplaceApproximation(model_fn)
+    else:
+        raise RuntimeError(f"Unknown engine {engine} (must be one of nuts, svi, laplace)")
+
+    fit_key, sample_key = random.split(random.PRNGKey(iteration))
+    params = fit_guide(model_fn, guide, model_args, num_steps, learning_rate, fit_key, verbose)
+    num_samples = -(-num_samples // thin)
+    # jitted since the laplace guide otherwise evaluates its hessian op by op
+    sample_posterior = jax.jit(lambda key, params: guide.sample_posterior(key, params, *model_args, sample_shape=(num_samples,)))
+    samples = sample_posterior(sample_key, params)
+    return {name: np.asarray(samples[name])[None] for name in ['rho', 'tau']}
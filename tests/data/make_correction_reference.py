@@ -0,0 +1,76 @@
+"""
+Write correction_reference.tsv - a short simulated readcount/gc/map track and its copy column corrected by the steps
+of HMMcopy's correctReadcount, run on the reference smoothers its R code calls (R's loess is netlib's dloess, wrapped
+by scikit-misc, and R's lowess is clowess, ported by statsmodels). Needs scikit-misc and statsmodels, which the
+package itself does not use:
+
+    python tests/data/make_correction_reference.py
+
+Fewer bins than correctReadcount's samplesize are simulated, so every fit uses all of its candidate bins and R's
+sample() does not change the result. Mappability has no ties, as clowess windows over tied values depend on their order
+"""
+import os
+import numpy as np
+import pandas as pd
+from skmisc.loess import loess
+from statsmodels.nonparametric.smoothers_lowess import lowess
+
+NUM_BINS = 3000
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'correction_reference.tsv')
+
+
+def simulate(rng):
+    gc = rng.normal(0.42, 0.06, 2 * NUM_BINS)
+    gc = gc[(gc > 0.2) & (gc < 0.7)][:NUM_BINS].round(6)  # no clipping, ties make the k-d tree of loess degenerate
+    gc[rng.random(NUM_BINS) < 0.01] = -1  # bins without gc content (ex. gaps) are written as -1 by gcCounter
+    # most bins are mappable enough to fit the gc curve on (loess needs a few thousand of them at span 0.03)
+    mapp = np.where(rng.random(NUM_BINS) < 0.85, rng.uniform(0.9, 1, NUM_BINS), rng.uniform(0.3, 0.9, NUM_BINS)).round(6)
+    bias = np.exp(-((gc - 0.45) / 0.15) ** 2) * mapp ** 2
+    reads = rng.poisson(200 * bias * rng.choice([0.5, 1, 1.5], NUM_BINS, p=[0.2, 0.6, 0.2]))
+    starts = np.arange(NUM_BINS) * 500000 + 1
+    return pd.DataFrame({'chr': '1', 'start': starts, 'end': starts + 499999, 'reads': reads, 'gc': gc, 'map': mapp})
+
+def predict(fit, x_min, x_max, x_new):
+    # R's predict.loess returns NA outside the range of the fitted x instead of extrapolating
+    fitted = np.full(len(x_new), np.nan)
+    inside = (x_new >= x_min) & (x_new <= x_max)
+    fitted[inside] = fit.predict(x_new[inside]).values
+    return fitted
+
+def approxfun(x, y):
+    # R's approxfun - tied x are averaged (ties=mean) and values outside the range of x are NA (rule=1)
+    unique_x, inverse = np.unique(x, return_inverse=True)
+    mean_y = np.bincount(inverse, weights=y) / np.bincount(inverse)
+    return lambda x_new: np.where((x_new >= unique_x[0]) & (x_new <= unique_x[-1]), np.interp(x_new, unique_x, mean_y), np.nan)
+
+def correct_readcount(x, mappability=0.9):
+    reads, gc, mapp = (x[column].to_numpy(dtype=float) for column in ['reads', 'gc', 'map'])
+    valid = (reads > 0) & (gc >= 0)
+    reads_range = np.quantile(reads[valid], [0, 1 - 0.01])
+    domain = np.quantile(gc[valid], [0.001, 1 - 0.001])
+    ideal = valid & (mapp >= mappability) & (reads > reads_range[0]) & (reads <= reads_range[1]) & (gc >= domain[0]) & (gc <= domain[1])
+
+    select = np.flatnonzero(ideal)
+    rough = loess(gc[select], reads[select], span=0.03)
+    rough.fit()
+    i = np.round(np.arange(0, 1001) * 0.001, 3)
+    rough_i = predict(rough, gc[select].min(), gc[select].max(), i)
+    defined = ~np.isnan(rough_i)  # na.omit
+    final = loess(i[defined], rough_i[defined], span=0.3)
+    final.fit()
+    cor_gc = reads / predict(final, i[defined].min(), i[defined].max(), gc)
+
+    cor_gc_range = np.nanquantile(cor_gc[valid], [0, 1 - 0.01])
+    with np.errstate(invalid='ignore'):
+        select = np.flatnonzero(cor_gc < cor_gc_range[1])
+    delta = 0.01 * (mapp[select].max() - mapp[select].min())
+    fitted = lowess(cor_gc[select], mapp[select], frac=2/3, it=3, delta=delta, return_sorted=True)
+    map_curve = approxfun(fitted[:, 0], fitted[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        copy = cor_gc / map_curve(mapp)
+        return np.where(copy > 0, np.log2(copy), np.nan)
+
+if __name__ == '__main__':
+    data = simulate(np.random.default_rng(0))
+    data['copy'] = correct_readcount(data)
+    data.to_csv(PATH, sep='\t', index=False, float_format='%.8g', na_rep='nan')
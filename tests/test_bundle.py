@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from src.bundle import ALIGNMENT, save_bundle, load_bundle
+
+
+def make_inputs(num_bins=37, num_clones=3):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=num_bins)
+    cn_profiles = rng.integers(0, 5, (num_bins, num_clones)).astype(np.uint8)
+    return data, cn_profiles
+
+@pytest.mark.parametrize('num_snvs', [None, 0, 11])
+def test_load_bundle_memory_maps_the_saved_arrays(tmp_path, num_snvs):
+    path = str(tmp_path / 'input.npz')
+    data, cn_profiles = make_inputs()
+    counts = None if num_snvs is None else np.random.default_rng(1).integers(0, 30, (num_snvs, 5)).astype(float)
+    save_bundle(path, data, cn_profiles, counts)
+
+    loaded_data, loaded_cn_profiles, loaded_counts = load_bundle(path)
+
+    assert isinstance(loaded_data, np.memmap) and isinstance(loaded_cn_profiles, np.memmap)
+    np.testing.assert_array_equal(loaded_data, data.astype(np.float32))
+    assert loaded_data.dtype == np.float32
+    np.testing.assert_array_equal(loaded_cn_profiles, cn_profiles)
+    assert loaded_cn_profiles.dtype == np.uint8  # integer copy numbers keep their dtype
+    if counts is None:
+        assert loaded_counts is None
+    else:
+        assert isinstance(loaded_counts, np.memmap)
+        assert loaded_counts.shape == counts.shape
+        np.testing.assert_array_equal(loaded_counts, counts.astype(np.float32))
+    for array in [loaded_data, loaded_cn_profiles] + ([] if num_snvs in [None, 0] else [loaded_counts]):
+        assert array.offset % ALIGNMENT == 0
+
+def test_bundle_is_a_regular_npz(tmp_path):
+    path = str(tmp_path / 'input.npz')
+    data, cn_profiles = make_inputs()
+    save_bundle(path, data, cn_profiles)
+    with np.load(path) as f:
+        assert sorted(f.files) == ['cn_profiles', 'data']
+        np.testing.assert_array_equal(f['cn_profiles'], cn_profiles)
+
+def test_load_bundle_reads_compressed_npz(tmp_path):
+    path = str(tmp_path / 'input.npz')
+    data, cn_profiles = make_inputs()
+    np.savez_compressed(path, data=data, cn_profiles=cn_profiles)
+    loaded_data, loaded_cn_profiles, loaded_counts = load_bundle(path)
+    np.testing.assert_array_equal(loaded_data, data)
+    np.testing.assert_array_equal(loaded_cn_profiles, cn_profiles)
+    assert loaded_counts is None
+
+def test_load_bundle_requires_data_and_cn_profiles(tmp_path):
+    path = str(tmp_path / 'input.npz')
+    np.savez(path, data=np.zeros(3))
+    with pytest.raises(RuntimeError, match='cn_profiles'):
+        load_bundle(path)
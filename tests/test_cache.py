@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+from src.cache import make_key, get_cache_path, load_cached, store_cached, evict
+
+
+def test_make_key_depends_on_every_part():
+    assert make_key('a', 1, (2, 3)) == make_key('a', 1, (2, 3))
+    assert make_key('a', 1, (2, 3)) != make_key('a', 1, (2, 4))
+    assert make_key('a', 1) != make_key('a', 1, None)
+
+def test_store_and_load_round_trip(tmp_path):
+    temp_dir = str(tmp_path)
+    arrays = {'data': np.arange(10, dtype=np.float32), 'bins': np.ones((10, 3), dtype=np.int32)}
+    store_cached(temp_dir, 'bins', 'key', arrays, 100)
+
+    loaded = load_cached(temp_dir, 'bins', 'key')
+    assert set(loaded) == set(arrays)
+    for name, array in arrays.items():
+        np.testing.assert_array_equal(loaded[name], array)
+        assert loaded[name].dtype == array.dtype
+    assert load_cached(temp_dir, 'bins', 'other') is None
+    assert load_cached(temp_dir, 'counts', 'key') is None
+    # no temporary files are left next to the entry
+    assert os.listdir(os.path.dirname(get_cache_path(temp_dir, 'bins', 'key'))) == ['key.npz']
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    temp_dir = str(tmp_path)
+    array = {'a': np.zeros(100000)}  # 0.8 MB per entry
+    for i, key in enumerate(['first', 'second', 'third']):
+        store_cached(temp_dir, 'x', key, array, 100)
+        os.utime(get_cache_path(temp_dir, 'x', key), ns=(i * 10**9, i * 10**9))
+
+    load_cached(temp_dir, 'x', 'first')  # most recently used now
+    evict(temp_dir, 2)
+
+    assert load_cached(temp_dir, 'x', 'second') is None
+    assert load_cached(temp_dir, 'x', 'first') is not None
+    assert load_cached(temp_dir, 'x', 'third') is not None
+
+def test_store_evicts_beyond_cache_size(tmp_path):
+    temp_dir = str(tmp_path)
+    for key in ['first', 'second']:
+        store_cached(temp_dir, 'x', key, {'a': np.zeros(100000)}, 1)
+    # both entries do not fit in 1 MB, the newest one is kept
+    assert load_cached(temp_dir, 'x', 'first') is None
+    assert load_cached(temp_dir, 'x', 'second') is not None
+
+def test_load_of_evicted_entry_is_a_miss(tmp_path, monkeypatch):
+    temp_dir = str(tmp_path)
+    store_cached(temp_dir, 'x', 'key', {'a': np.zeros(10)}, 100)
+    path = get_cache_path(temp_dir, 'x', 'key')
+
+    # another process evicts the entry after the existence check
+    def load(*args, **kwargs):
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(np, 'load', load)
+    assert load_cached(temp_dir, 'x', 'key') is None
+
+def test_evict_skips_entries_removed_by_other_processes(tmp_path, monkeypatch):
+    temp_dir = str(tmp_path)
+    for key in ['first', 'second']:
+        store_cached(temp_dir, 'x', key, {'a': np.zeros(100000)}, 100)
+
+    remove = os.remove
+    def remove_twice(path):
+        remove(path)
+        remove(path)  # as if another process removed it first
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    evict(temp_dir, 0)
+    assert load_cached(temp_dir, 'x', 'first') is None
+    assert load_cached(temp_dir, 'x', 'second') is None
@@ -0,0 +1,22 @@
+import os
+import numpy as np
+import pandas as pd
+
+from src.correction import correct_readcount
+
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'correction_reference.tsv')
+MAX_DIFFERENCE = 0.015  # log2 units, as documented by correct_readcount
+QUANTILE_DIFFERENCE = 0.01  # 99th percentile
+
+
+def test_correct_readcount_matches_the_reference():
+    # see tests/data/make_correction_reference.py
+    reference = pd.read_csv(REFERENCE_PATH, sep='\t', dtype={'chr': str})
+    corrected = correct_readcount(reference.drop(columns='copy'))
+
+    copy, expected = corrected['copy'].to_numpy(), reference['copy'].to_numpy()
+    np.testing.assert_array_equal(np.isnan(copy), np.isnan(expected))
+    differences = np.abs(copy - expected)[~np.isnan(expected)]
+    assert np.max(differences) < MAX_DIFFERENCE
+    assert np.quantile(differences, 0.99) < QUANTILE_DIFFERENCE
+    np.testing.assert_array_equal(corrected['valid'], (reference['reads'] > 0) & (reference['gc'] >= 0))
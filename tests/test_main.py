@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from src.main import preprocess
+
+
+@pytest.mark.parametrize('model', ['cn', 'base'])
+def test_preprocess_skips_snv_counting_for_the_cn_model(tmp_path, model):
+    from benchmarks.synthetic import simulate_rho, simulate_cn_profiles, simulate_data
+    rng = np.random.default_rng(0)
+    profiles = simulate_cn_profiles(200, 2, rng)
+    data_path, cn_profiles_path = str(tmp_path / 'data.tsv'), str(tmp_path / 'cn_profiles.bed')
+    np.savetxt(data_path, simulate_data(profiles, simulate_rho(2, rng), 0.1, rng))
+    np.savetxt(cn_profiles_path, profiles, fmt='%d', delimiter='\t')
+
+    # the clone bams and vcf do not exist, so counting them would fail
+    data, cn_profiles, counts = preprocess(data_path, cn_profiles_path, ('missing.bam',), ('missing.vcf.gz',), None, model,
+                                           None, None, '1', '500000', '20', False, str(tmp_path), 1, 'coverage', False, 1024,
+                                           'hmmcopy', 'readcounter')
+    assert counts is None
+    assert len(data) == len(cn_profiles) > 0
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from numpyro.infer.util import log_density
+
+from src.inference import get_model
+
+
+def simulate_inputs(rng, num_bins=300, num_snvs=200, num_clones=3):
+    cn_profiles = rng.integers(1, 5, (num_bins, num_clones + 1)).astype(np.uint8)
+    data = rng.normal(0, 0.3, num_bins)
+    # few distinct clone coefficients, so SNVs are aggregated by the compressed model
+    coefficients = rng.integers(0, 3, (num_snvs, num_clones)) * 0.5
+    depths = rng.poisson(30, num_snvs)
+    alt = rng.binomial(depths, 0.3)
+    counts = np.c_[depths - alt, alt, coefficients].astype(float)
+    return data, cn_profiles, counts
+
+@pytest.mark.parametrize('model', ['cn', 'cn_snv'])
+def test_compressed_models_match_up_to_a_constant(model):
+    rng = np.random.default_rng(0)
+    data, cn_profiles, counts = simulate_inputs(rng)
+    full_fn, full_args = get_model(model, data, cn_profiles, counts, compress=False)
+    compressed_fn, compressed_args = get_model(model, data, cn_profiles, counts, compress=True)
+    assert compressed_fn.__name__ == f'compressed_{full_fn.__name__}'
+    assert len(compressed_args[1]) < len(cn_profiles)  # bins and SNVs were aggregated
+    if model == 'cn_snv':
+        assert len(compressed_args[4]) < len(counts)
+
+    differences = []
+    for _ in range(10):
+        params = {'rho': rng.dirichlet(np.ones(cn_profiles.shape[1])).astype(np.float32),
+                  'tau': np.float32(rng.uniform(0.05, 1))}
+        full, _ = log_density(full_fn, full_args, {}, params)
+        compressed, _ = log_density(compressed_fn, compressed_args, {}, params)
+        differences.append(float(full) - float(compressed))
+
+    # the binomial normaliser of the SNVs is all that differs
+    np.testing.assert_allclose(differences, differences[0], atol=1e-2)
+    if model == 'cn':
+        np.testing.assert_allclose(differences[0], 0, atol=1e-2)
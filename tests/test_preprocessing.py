@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.preprocessing import match_contigs, count_reads, intersect, fit_gmms, remove_outliers
+
+
+def test_match_contigs_with_and_without_chr_prefix():
+    assert match_contigs('1,2,X', ['chr1', 'chr2', 'chrX']) == (['chr1', 'chr2', 'chrX'], [])
+    assert match_contigs('chr1,2', ['1', '2']) == (['1', '2'], [])
+    assert match_contigs('1,2,3', ['1', 'chr2']) == (['1', 'chr2'], ['3'])
+
+def test_count_reads_on_chr_named_bam(tmp_path):
+    from benchmarks.synthetic import write_bam
+    path = str(tmp_path / 'sample.bam')
+    write_bam(path, [('chr1', 200000), ('chr2', 100000)], 200, np.random.default_rng(0))
+
+    with pytest.warns(UserWarning, match='Chromosomes 3 are not contigs'):
+        readcounts = count_reads(path, '1,2,3', '50000', '0', 1, False)
+    assert list(readcounts.groupby('chr', sort=False).size().items()) == [('chr1', 4), ('chr2', 2)]
+    assert readcounts['start'].iloc[1] == 50001 and readcounts['end'].iloc[1] == 100000
+
+    with pytest.raises(RuntimeError, match='contigs: chr1, chr2'):
+        count_reads(path, '5,6', '50000', '0', 1, False)
+
+def test_intersect_averages_readcount_bins_by_midpoint(tmp_path):
+    path = str(tmp_path / 'cn_profiles.bed')
+    # unsorted, with a copy-number bin without readcounts (1:2001-3000) and one on a contig without readcounts (3)
+    with open(path, 'w') as f:
+        f.write('2\t1\t1000\t2\t4\n1\t1001\t2000\t3\t2\n1\t1\t1000\t2\t2\n1\t2001\t3000\t1\t2\n3\t1\t1000\t2\t2\n')
+    readcounts = pd.DataFrame([('chr1', 1, 500, 0.1),
+                               ('1', 501, 1000, 0.3),
+                               ('1', 901, 1400, 0.5),      # overlaps two copy-number bins, joined by its midpoint
+                               ('1', 1401, 1900, np.nan),  # ignored
+                               ('chr2', 1, 1000, -0.4),
+                               ('X', 1, 1000, 1.0),        # contigs without copy-number bins
+                               ('7', 1, 1000, 1.0)], columns=['chr', 'start', 'end', 'copy'])
+
+    data, bins, cn_profiles = intersect(readcounts, path)
+
+    np.testing.assert_allclose(data, [0.2, 0.5, -0.4], rtol=1e-6)
+    assert data.dtype == np.float32
+    np.testing.assert_array_equal(bins, [[1, 1, 1000], [1, 1001, 2000], [2, 1, 1000]])
+    np.testing.assert_array_equal(cn_profiles, [[2, 2], [3, 2], [2, 4]])
+
+def test_intersect_matches_equal_bins_row_for_row(tmp_path):
+    from benchmarks.synthetic import simulate_cn_profiles
+    rng = np.random.default_rng(0)
+    profiles = simulate_cn_profiles(500, 2, rng)
+    path = str(tmp_path / 'cn_profiles.bed')
+    np.savetxt(path, profiles, fmt='%d', delimiter='\t')
+    copy = rng.normal(size=len(profiles))
+    readcounts = pd.DataFrame({'chr': profiles[:, 0].astype(int).astype(str), 'start': profiles[:, 1].astype(int),
+                               'end': profiles[:, 2].astype(int), 'copy': copy})
+
+    data, bins, cn_profiles = intersect(readcounts, path)
+
+    np.testing.assert_allclose(data, copy.astype(np.float32))
+    np.testing.assert_array_equal(bins, profiles[:, :3])
+    np.testing.assert_array_equal(cn_profiles, profiles[:, 3:])
+
+def make_clusters(rng, center, num_core=300, num_outliers=30):
+    # a tight cluster of bins and a well separated, wider one
+    return np.r_[rng.normal(center, 0.05, num_core), rng.normal(center + 3, 0.5, num_outliers)]
+
+def test_fit_gmms_assigns_the_wide_cluster_to_the_larger_variance():
+    rng = np.random.default_rng(0)
+    values = np.r_[make_clusters(rng, 0), make_clusters(rng, -1, 200, 20)]
+    groups = np.repeat([0, 1], [330, 220])
+
+    labels, variances = fit_gmms(values, groups, 2)
+
+    outlier_component = np.argmax(variances, axis=1)
+    outliers = labels == outlier_component[groups]
+    np.testing.assert_array_equal(np.flatnonzero(outliers), np.r_[300:330, 330 + 200:550])
+    # groups are fitted independently
+    for group in [0, 1]:
+        group_labels, group_variances = fit_gmms(values[groups == group], np.zeros(np.sum(groups == group), dtype=int), 1)
+        np.testing.assert_array_equal(group_labels, labels[groups == group])
+        np.testing.assert_allclose(group_variances[0], variances[group])
+
+def test_remove_outliers_drops_the_wide_cluster_and_nan():
+    rng = np.random.default_rng(1)
+    data = np.r_[make_clusters(rng, 0), rng.normal(5, 1, 40)].astype(np.float32)  # the last configuration has < 50 bins
+    data[10] = np.nan
+    cn_profiles = np.repeat([[2, 2], [3, 2]], [330, 40], axis=0).astype(np.uint8)
+    bins = np.c_[np.ones(len(data)), np.arange(len(data)) * 1000 + 1, np.arange(1, len(data) + 1) * 1000].astype(np.int32)
+
+    kept_data, kept_bins, kept_cn_profiles = remove_outliers(data, bins, cn_profiles, False)
+
+    kept = np.r_[0:10, 11:300, 330:370]
+    np.testing.assert_array_equal(kept_data, data[kept])
+    np.testing.assert_array_equal(kept_bins, bins[kept])
+    np.testing.assert_array_equal(kept_cn_profiles, cn_profiles[kept])
@@ -0,0 +1,32 @@
+import numpy as np
+import pysam
+
+from src.process_snvs import BASES, parse_sites
+
+
+def write_vcf(path, records):
+    header = pysam.VariantHeader()
+    header.contigs.add('1', length=100000)
+    header.contigs.add('X', length=100000)
+    with pysam.VariantFile(path, 'w', header=header) as vcf:
+        for contig, start, alleles in records:
+            vcf.write(vcf.new_record(contig=contig, start=start, alleles=alleles))
+
+def test_parse_sites_keeps_only_single_base_snvs(tmp_path):
+    path = str(tmp_path / 'tissue.vcf')
+    write_vcf(path, [('1', 999, ('C', 'T')),           # SNV at 1-based position 1000
+                     ('1', 1000, ('AC', 'A')),         # deletion
+                     ('1', 1001, ('A', 'ACG')),        # insertion
+                     ('1', 1010, ('AC', 'GT')),        # MNP
+                     ('1', 1020, ('G', 'N')),          # not a base
+                     ('X', 1030, ('G', 'A')),          # non-numeric contig
+                     ('1', 1040, ('G', 'A'))])         # SNV at 1-based position 1041
+
+    sites = parse_sites(path)
+
+    assert list(sites['contigs']) == ['1']
+    assert list(sites['contig_id']) == [0, 0]
+    assert list(sites['pos']) == [1000, 1041]
+    assert [BASES[i] for i in sites['ref']] == ['C', 'G']
+    assert [BASES[i] for i in sites['alt']] == ['T', 'A']
+    assert sites['pos'].dtype == np.int64
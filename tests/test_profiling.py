@@ -0,0 +1,30 @@
+import time
+
+from src import profiling
+from src.profiling import profiled, stage, read_stages, COMPILE_EVENT_PREFIX
+
+
+def test_nested_compile_events_are_counted_once(tmp_path, monkeypatch):
+    path = str(tmp_path / 'profile.json')
+    clock = [0.0]
+    monkeypatch.setattr(time, 'perf_counter', lambda: clock[0])
+
+    def event(name, end, duration):
+        clock[0] = end
+        profiling._record_compilation(COMPILE_EVENT_PREFIX + name, duration)
+
+    with profiled(path):
+        with stage('inference'):
+            event('backend_compile_duration', 11, 1)      # compiled while the outer function is traced
+            event('jaxpr_trace_duration', 12, 3)          # 9-12, covers the event above
+            event('jaxpr_to_mlir_module_duration', 14, 2)
+            event('backend_compile_duration', 20, 4)
+            event('jaxpr_trace_duration', 20.5, 1)        # 19.5-20.5, half covered
+            profiling._record_compilation('/jax/other_event', 100)
+
+    stages = {record['name']: record for record in read_stages(path)}
+    assert stages['inference']['compile_seconds'] == 3 + 2 + 4 + 0.5
+    assert stages['total']['compile_seconds'] == stages['inference']['compile_seconds']
+
+def test_compile_events_outside_profiling_are_ignored():
+    profiling._record_compilation(COMPILE_EVENT_PREFIX + 'backend_compile_duration', 1)
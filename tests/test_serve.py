@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from src.bundle import save_bundle
+from src.serve import parse_job, JobQueue
+
+
+def test_parse_job_checks_params_like_the_command_line():
+    kwargs = parse_job({'liquid_bam': 'input.npz', 'output': 'results.csv', 'clone_bams': ['A.bam', 'B.bam'], 'num_samples': 20})
+    assert kwargs['clone_bams'] == ('A.bam', 'B.bam')
+    assert kwargs['num_samples'] == 20
+    assert kwargs['num_workers'] == 1  # defaults of the run command
+    with pytest.raises(RuntimeError, match='Unknown run parameters unknown'):
+        parse_job({'liquid_bam': 'input.npz', 'output': 'results.csv', 'unknown': 1})
+    with pytest.raises(RuntimeError, match='output'):
+        parse_job({'liquid_bam': 'input.npz'})
+
+@pytest.fixture(scope='module')
+def queue(tmp_path_factory):
+    queue = JobQueue(1, str(tmp_path_factory.mktemp('jobs')), [], False)
+    yield queue
+    queue.shutdown()
+
+def test_queue_rejects_jobs_the_workers_cannot_run(queue, monkeypatch):
+    monkeypatch.setattr('os.cpu_count', lambda: 4)  # the workers have a single device, parallel chains would need two
+    num_jobs = len(queue.list_jobs())
+    with pytest.raises(RuntimeError, match='num_workers must be 1'):
+        queue.submit({'liquid_bam': 'input.npz', 'output': 'results.csv', 'num_workers': 4})
+    with pytest.raises(RuntimeError, match='serve --num-chains 2'):
+        queue.submit({'liquid_bam': 'input.npz', 'output': 'results.csv', 'num_chains': 2})
+    assert len(queue.list_jobs()) == num_jobs
+
+def test_queue_runs_a_job(queue, tmp_path):
+    from benchmarks.synthetic import simulate_rho, simulate_cn_profiles, simulate_data
+    rng = np.random.default_rng(0)
+    profiles = simulate_cn_profiles(200, 2, rng)
+    input_path, output_path = str(tmp_path / 'input.npz'), str(tmp_path / 'results.csv')
+    save_bundle(input_path, simulate_data(profiles, simulate_rho(2, rng), 0.1, rng), profiles[:, 3:])
+
+    job = queue.submit({'liquid_bam': input_path, 'output': output_path, 'num_samples': 20, 'num_warmup': 20,
+                        'temp_dir': str(tmp_path / 'temp'), 'use_cache': False})
+    assert job['state'] in ['queued', 'running'] and job['params']['pad_buckets']
+    queue.jobs[job['id']]['future'].result(timeout=600)
+
+    job = queue.get_job(job['id'])
+    assert job['state'] == 'done', job.get('error')
+    assert job['started'] <= job['finished']
+    assert 'inference' in [record['name'] for record in job['stages']]
+    assert (tmp_path / 'results.csv').exists()